@@ -0,0 +1,80 @@
+# This script will compare the speed of the original (row by row) formatting of the time series with the bulk formatting in smapUtils, and check that both produce the same text.
+# The data are random values of the SMAP fields, including fill values, nan and data without a retrieval.
+
+import time
+import numpy as np
+from smapUtils import getFieldsAndDataTypes, removeNoData, formatAsString, formatBatchAsStrings
+
+# ----------------------------------------------------------------
+# Controls
+
+# Lengths of the series of one pixel (number of retrievals) to time
+seriesLengths = [100, 1000, 10000, 40000]
+# Size of the batch ([nPixels,nTime]) to time
+batchPixels = 2000
+batchTime = 16
+# Seed of the random data
+seed = 0
+
+# ----------------------------------------------------------------
+# Functions
+
+# The original formatting: one format and one string concatenation per row
+def formatAsStringLoop(smapTs):
+    fields, dataTypes, printFormat = getFieldsAndDataTypes()
+    headerStr = fields[0] + ' {}\n'.format(smapTs[fields[0]][0]) + \
+                fields[1] + ' {}\n'.format(smapTs[fields[1]][0]) + \
+                ' '.join(fields[2:]) + '\n'
+    bodyStr = ''
+    for ll in range(len(smapTs)):
+        bodyStr = bodyStr + printFormat.format(smapTs[fields[2]][ll], smapTs[fields[3]][ll], smapTs[fields[4]][ll], smapTs[fields[5]][ll], smapTs[fields[6]][ll], smapTs[fields[7]][ll], smapTs[fields[8]][ll], smapTs[fields[9]][ll], smapTs[fields[10]][ll])
+    return bodyStr, headerStr
+
+# Function to create random SMAP data of the given shape
+def randomSmapData(shape, rng):
+    fields, dataTypes = getFieldsAndDataTypes()[:2]
+    data = np.empty(shape, dtype=dataTypes)
+    for name, dtype in dataTypes:
+        if np.dtype(dtype).kind == 'f':
+            data[name] = rng.normal(100, 100, shape)
+        elif np.dtype(dtype).kind == 'u':
+            data[name] = rng.integers(0, 65536, shape)
+    data['tb_time_utc'] = '2015-04-01T12:34:56.789Z'
+    data['localTime'] = np.where(rng.random(shape) < 0.5, 'AM', 'PM')
+    # Fill values, nan and retrievals without data
+    data['soil_moisture'][rng.random(shape) < 0.1] = -9999.0
+    data['vegetation_water_content'][rng.random(shape) < 0.1] = np.nan
+    data['longitude'][rng.random(shape) < 0.2] = -9999.0
+    return data
+
+# ----------------------------------------------------------------
+# Benchmark
+
+rng = np.random.default_rng(seed)
+print('{0:>8s} {1:>10s} {2:>10s} {3:>8s}'.format('rows', 'loop (s)', 'bulk (s)', 'speedup'))
+for nRows in seriesLengths:
+    smapTs = removeNoData(randomSmapData([nRows], rng))
+    tic = time.perf_counter()
+    loopStrs = formatAsStringLoop(smapTs)
+    tLoop = time.perf_counter() - tic
+    tic = time.perf_counter()
+    bulkStrs = formatAsString(smapTs)
+    tBulk = time.perf_counter() - tic
+    if loopStrs != bulkStrs:
+        raise ValueError('Bulk formatting differs from the original for ' + str(nRows) + ' rows')
+    print('{0:8d} {1:10.4f} {2:10.4f} {3:8.1f}'.format(len(smapTs), tLoop, tBulk, tLoop/tBulk))
+
+# A whole batch of pixels
+batchTs = randomSmapData([batchPixels, batchTime], rng)
+tic = time.perf_counter()
+loopStrs = []
+for pp in range(batchPixels):
+    smapTsClean = removeNoData(batchTs[pp])
+    loopStrs.append(formatAsStringLoop(smapTsClean) if len(smapTsClean) > 0 else None)
+tLoop = time.perf_counter() - tic
+tic = time.perf_counter()
+bulkStrs = formatBatchAsStrings(batchTs)
+tBulk = time.perf_counter() - tic
+if loopStrs != bulkStrs:
+    raise ValueError('Batch formatting differs from the original')
+print('Batch of {0} pixels x {1} times: loop {2:.4f} s, bulk {3:.4f} s, speedup {4:.1f}'.format(batchPixels, batchTime, tLoop, tBulk, tLoop/tBulk))
@@ -0,0 +1,110 @@
+# This script will time the stages of createTimeseries.py on synthetic SMAP files (see smapSynthetic.py), for several domain sizes and numbers of days.
+# For each case it reports the time of each stage, the throughput (pixel-days per second) and the peak memory (RSS), so that performance regressions show up.
+# Each case runs in its own process, so that its peak memory is not hidden by the cases before it.
+
+import datetime as dt
+import json
+import multiprocessing as mp
+import resource
+import shutil
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from smapUtils import *
+from smapProducts import getProduct
+from smapStore import createTsStore, appendToTsStore
+from smapSynthetic import writeSyntheticArchive
+
+# ----------------------------------------------------------------
+# Controls
+
+# Directory of the synthetic SMAP files and of the output of the benchmark
+workDir = '../../data/benchmark'
+# SMAP product to time (see getProductTable in smapProducts.py): 'SMP' (36 km) or 'SMP_E' (9 km enhanced)
+smapType = 'SMP'
+# First day of the synthetic data
+dateStart = dt.date(2015,4,1)
+# Domain sizes to time: number of NLDAS pixels in lon and lat (centered on the NLDAS domain; 464x224 is the full domain)
+domainSizes = [(24, 8), (116, 56), (464, 224)]
+# Numbers of days to time (all days are read as one batch)
+nDaysList = [2, 8]
+# File where the results are appended (one JSON object per line)
+resultsFn = workDir + '/benchmarkResults.jsonl'
+
+# ----------------------------------------------------------------
+# Functions
+
+# Function to create a domain of nLon x nLat NLDAS pixels, centered on the NLDAS domain
+def benchmarkDomain(nLon, nLat):
+    lonVals = -124.9375 + 0.125*((464-nLon)//2 + np.arange(nLon))
+    latVals = 25.0625 + 0.125*((224-nLat)//2 + np.arange(nLat))
+    return makeDomain(lonVals, latVals)
+
+# Function to run one case and return the time (s) of each stage and the peak RSS (MB)
+def runCase(smapDir, outDir, nLon, nLat, nDays):
+    timings = {}
+    def timed(stage, func, *args, **kwargs):
+        tic = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - tic
+        return result
+    dates = [dateStart + dt.timedelta(days=dd) for dd in range(nDays)]
+    domainPixelsArr = benchmarkDomain(nLon, nLat)
+    # Grid and window of the domain
+    product = getProduct(smapType)
+    lonData, latData = timed('grid', getGridLonLat, product['nLat'], product['nLon'])
+    minLon = np.min(domainPixelsArr['longitude'])-0.5
+    maxLon = np.max(domainPixelsArr['longitude'])+0.5
+    minLat = np.min(domainPixelsArr['latitude'])-0.5
+    maxLat = np.max(domainPixelsArr['latitude'])+0.5
+    rows, cols = timed('grid', getTrimSlices, lonData,latData,minLon,maxLon,minLat,maxLat)
+    trimmedLon = lonData[cols]
+    trimmedLat = latData[rows]
+    # Pixel selection
+    lonIdcs, latIdcs = timed('select', selectSmapPixels, trimmedLon, trimmedLat, domainPixelsArr)
+    # Read the days (only the domain pixels are kept, as createTimeseries.py does) and assemble them into the batch
+    dayData = [timed('read', readSmapDay, thisDate, smapDir, smapType, rows, cols, pixels=(latIdcs, lonIdcs)) for thisDate in dates]
+    batchTs = timed('assemble', assembleBatch, dates, dayData)
+    del dayData
+    # Format and write the text files
+    strings = timed('format', lambda: formatBatchAsStrings(columnsToRecords(batchTs)))
+    textDir = Path(outDir) / 'text'
+    textDir.mkdir(parents=True)
+    def writeText():
+        for pixelId, pixelStrs in zip(domainPixelsArr['pixelId'], strings):
+            if pixelStrs is not None:
+                writeToFile(str(textDir / (pixelId + '.txt')), pixelStrs[0], pixelStrs[1])
+    timed('write_text', writeText)
+    # Write the store
+    storeFn = str(Path(outDir) / 'smapTs.h5')
+    timed('write_hdf5', lambda: (createTsStore(storeFn, domainPixelsArr), appendToTsStore(storeFn, batchTs, dates)))
+    # Peak RSS of this process (ru_maxrss is in KB on Linux, bytes on macOS)
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024**2 if sys.platform == 'darwin' else 1024)
+    return timings, peakRss
+
+# ----------------------------------------------------------------
+# Benchmark
+
+# Synthetic SMAP files for the longest case
+smapDir = workDir + '/smapData'
+print('Writing synthetic ' + smapType + ' files in ' + smapDir + '...')
+writeSyntheticArchive(smapDir, dateStart, dateStart + dt.timedelta(days=max(nDaysList)), type=smapType)
+
+stages = ['grid', 'select', 'read', 'assemble', 'format', 'write_text', 'write_hdf5']
+print('{0:>9s} {1:>5s} {2:>8s}'.format('domain', 'days', 'pixels') + ''.join(' {0:>10s}'.format(stage) for stage in stages) + ' {0:>10s} {1:>12s} {2:>9s}'.format('total (s)', 'pix-days/s', 'RSS (MB)'))
+for nLon, nLat in domainSizes:
+    for nDays in nDaysList:
+        outDir = Path(workDir) / 'output'
+        shutil.rmtree(outDir, ignore_errors=True)
+        # Run the case in a fresh process
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('fork')) as pool:
+            timings, peakRss = pool.submit(runCase, smapDir, outDir, nLon, nLat, nDays).result()
+        shutil.rmtree(outDir, ignore_errors=True)
+        pixelDays = nLon*nLat*nDays
+        total = sum(timings.values())
+        print('{0:>9s} {1:5d} {2:8d}'.format(str(nLon) + 'x' + str(nLat), nDays, nLon*nLat) + ''.join(' {0:10.3f}'.format(timings[stage]) for stage in stages) + ' {0:10.3f} {1:12.0f} {2:9.0f}'.format(total, pixelDays/total, peakRss))
+        # Append the results
+        with open(resultsFn, 'a') as fid:
+            fid.write(json.dumps({'date': dt.datetime.now().isoformat(timespec='seconds'), 'smapType': smapType, 'nLon': nLon, 'nLat': nLat, 'nDays': nDays, 'seconds': timings, 'pixelDaysPerSecond': {stage: pixelDays/timings[stage] for stage in stages if timings[stage] > 0}, 'totalSeconds': total, 'peakRssMB': peakRss}) + '\n')
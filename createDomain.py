@@ -1,7 +1,9 @@
-# This file will define the NLDAS-2 domain as a 2-column list of lons and lats, to be read in by the createTimeseries.py file.
+# This file will define the NLDAS-2 domain as a list of lons, lats and pixel IDs, to be read in by the createTimeseries.py file.
+# The domain is written as a binary file (.npy or .h5) that is loaded without parsing, and optionally exported in the original text format (see writeDomain in smapUtils.py).
 # P. Shellito, Jul 19, 2018
 
 import numpy as np
+from smapUtils import makeDomain, getLandMask, writeDomain
 
 # Range of NDLAS-2 Lon values
 lonMin=-124.9375
@@ -20,16 +22,20 @@ latRes=0.125
 latN=224
 latVals = np.arange(latMin,latMax+latRes/2,latRes)
 
-# Name of file to save as
-fileN = 'nldasDomainSection.txt'
-# Open the file to write to
-fid = open(fileN,'w')
-# Print header
-fid.write('#     Lon       Lat    PixelId\n')
-# Print every combination of lon/lat in a text file
-for oo in range(len(lonVals)):
-    for aa in range(len(latVals)):
-        fid.write('{0:>9.4f} {1:>9.4f}    nId{2:03}{3:03}\n'.format(lonVals[oo], latVals[aa], oo,aa))
+# Land mask: a .npz file with the 1-d 'longitude' and 'latitude' of a grid and its [nLon,nLat] boolean 'mask' (True over land). Only the land pixels are kept. None keeps every pixel.
+landMaskFile = None
 
-# Close the file
-fid.close()
+# Name of file to save as (.npy or .h5)
+fileN = 'nldasDomainSection.npy'
+# Name of the text file to also export the domain to (None to not export it)
+textFileN = None
+#textFileN = 'nldasDomainSection.txt'
+
+# Every combination of lon/lat (only over land if a land mask is given)
+landMask = None if landMaskFile is None else getLandMask(landMaskFile, lonVals, latVals)
+domainPixelsArr = makeDomain(lonVals, latVals, landMask)
+print('Writing ' + str(len(domainPixelsArr)) + ' pixels to ' + fileN + '...')
+writeDomain(fileN, domainPixelsArr)
+# Export the text format
+if textFileN is not None:
+    writeDomain(textFileN, domainPixelsArr)
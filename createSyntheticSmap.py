@@ -0,0 +1,25 @@
+# This script will write synthetic SMAP L3 files (SPL3SMP or SPL3SMP_E) for a range of days, in the directory layout that getFn expects (see smapSynthetic.py).
+# Use them to run and time the other scripts without the real SMAP archive.
+
+import datetime as dt
+from smapSynthetic import writeSyntheticArchive
+
+# ----------------------------------------------------------------
+# Controls
+
+# Date of the first file
+dateStart = dt.date(2015,3,31)
+# Date to end (no file is written for this day)
+dateEnd = dt.date(2015,4,8)
+# Directory where the synthetic SMAP data are written
+smapDir = '../../data/smapSynthetic'
+# SMAP product (see getProductTable in smapProducts.py): 'SMP' (36 km) or 'SMP_E' (9 km enhanced)
+smapType = 'SMP'
+# Seed of the random values
+seed = 0
+
+# ----------------------------------------------------------------
+# Write the files
+
+print('Writing synthetic SMAP files from ' + dateStart.isoformat() + ' to ' + (dateEnd-dt.timedelta(days=1)).isoformat() + ' in ' + smapDir + '...')
+writeSyntheticArchive(smapDir, dateStart, dateEnd, type=smapType, seed=seed)
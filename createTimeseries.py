@@ -5,8 +5,14 @@
 
 import datetime as dt
 import numpy as np
-import math
+import sys
+import time
 from smapUtils import *
+from smapStore import createTsStore, appendToTsStore, getTileStoreFn
+from smapProducts import getProduct
+from smapManifest import readManifest, newManifest, checkNoOutput, writeManifest, checkManifest, rollbackToManifest, getResumeDate, commitBatch, getAvailableDates, getManifestAggregatesFn, addManifestAggregates
+from smapAggregate import openAggregates, closeAggregates, getAggregatePairs, checkAggregates, updateAggregates, estimateAggregateDayBytes
+from smapMetrics import newMetrics, stageTimer, sizeOf, snapshotMetrics, diffMetrics, batchSummary, logMetrics, startProfile, stopProfile
 
 # ----------------------------------------------------------------
 # Controls
@@ -16,107 +22,192 @@ dateStart = dt.date(2015,3,31)
 # Date to end reading (will NOT read data on last day)
 dateEnd = dt.date(2015,4,8)
 #dateEnd = dt.date(2015,4,2)
+# Update mode: ignore dateEnd and extend the time series with every SMAP day that is available after the last day already written. Days without a SMAP file (outages of the archive) are skipped and recorded as such in the manifest.
+updateMode = False
+# Days already written (as recorded in the manifest of smapOutDir, see smapManifest.py) are never read again, and the writes of an interrupted run are rolled back before continuing
 
-# Number of days to read at once
-batchDays = 4
+# Number of days to read at once (None chooses the largest number that fits in memBudget)
+batchDays = None
+# Memory budget (bytes) used to choose batchDays
+memBudget = 4*1024**3
+# Directory where the batch data are memory-mapped when a batch does not fit in memBudget
+spillDir = '../../data/scratch'
+# Number of worker processes reading SMAP files (0 reads them one after the other in this process)
+nWorkers = 4
+# Number of batches to read ahead while the current batch is written. Each batch in flight costs another batch worth of memory. No batch is read ahead when the batches are memory-mapped (they would be held in memory until then).
+prefetchBatches = 1
 
-# Lon/Lat pairs to write out
-domainFile = 'nldasDomainSection.txt'
+# SMAP product to read (see getProductTable in smapProducts.py): 'SMP' (36 km) or 'SMP_E' (9 km enhanced)
+smapType = 'SMP'
+
+# Lon/Lat pairs to write out (written by createDomain.py: .npy, .h5 or text; if the .npy file does not exist, the .txt file of the same name is read)
+domainFile = 'nldasDomainSection.npy'
 # Directory where raw SMAP data are held
 smapDir = '../../data/smapData'
 # Directory where processed SMAP time series will be written
 smapOutDir = '../../data/smapTs'
+# Directory where the mapping from domain pixels to SMAP pixels is cached (None to not cache it)
+cacheDir = '../../data/cache'
+# Format of the time series: 'text' (one <pixelId>.txt file per pixel) or 'hdf5' (a single store, see smapStore.py; export it to text files with exportTimeseriesText.py)
+outputFormat = 'text'
+# Name of the store when outputFormat is 'hdf5'
+storeFn = smapOutDir + '/smapTs.h5'
+# Number of tiles the domain is split into. Each tile is processed by its own run, which reads only the tile's window of the SMAP files. The tile is given as the first command line argument or by the index of a cluster array job (e.g. sbatch --array=0-<nTiles-1>). The tiles write their own manifest (and store); combine them with mergeTiles.py.
+nTiles = 1
 
-# Total number of days to read
-totDays = (dateEnd-dateStart).days
-# Number of batches of data to go through
-nBatches = math.ceil(totDays/batchDays)
-# Fields and data types to read in
-fields, dataTypes = getFieldsAndDataTypes()[:2]
+# Retrievals to discard while reading: a dict of flag field -> list of flag names (see getFlagTable in smapFlags.py), e.g. {'retrieval_qual_flag': ['not_recommended_quality'], 'surface_flag': ['static_water']}. Retrievals with any of these flags raised are treated as no retrieval: they are not copied into the batches or written. None keeps every retrieval.
+qualityFilter = None
+
+# Fields and data types to read in (as columns, see getColumnDataTypes)
+columnTypes = getColumnDataTypes()
+
+# Fields to keep running statistics of (count, mean, variance, min, max per pixel, see smapAggregate.py), e.g. ['soil_moisture']. They are kept in a file of smapOutDir that every batch updates in place and that is rolled back with the manifest, so later runs keep extending them. None keeps no statistics (unless earlier runs kept them).
+aggregateFields = None
+# Groups of time steps to keep statistics for (see getAggregateGroups in smapAggregate.py)
+aggregateGroups = ['total', 'month', 'monthOfYear', 'dayOfYear']
+
+# File where the time and bytes of each stage of each batch are appended as JSON lines (see smapMetrics.py; None to only print a summary per batch)
+metricsFn = None
+#metricsFn = smapOutDir + '/metrics.jsonl'
+# Profile the run with cProfile (this process only, not the reading workers), saving the statistics to profileFn
+profileRun = False
+profileFn = smapOutDir + '/createTimeseries.prof'
 
 # ----------------------------------------------------------------
 # Get domain data
 
-# The first file's name
-firstFn = getFn(date=dateStart, smapDir=smapDir, type='SMP')
-# Read the lon/lat data from the first file
-smapLonLat = getSmapLonLat(fn=firstFn)
-# Replace -9999.0 with np.nan
-smapLonLat['longitude'][smapLonLat['longitude']==-9999.0]=np.nan
-smapLonLat['latitude'][smapLonLat['latitude']==-9999.0]=np.nan
-# Extract a 1-d array of lon and lat data
-lonData = np.nanmean(smapLonLat['longitude'],axis=0)
-latData = np.nanmean(smapLonLat['latitude'],axis=1)
-
 # Read file containing domain data
-with open(domainFile) as fid:
-    # Initialize vars to keep
-    domainPixels = []
-    # Skip the header
-    next(fid)
-    # Read the rest of the data
-    for line in fid:
-        thisLine = line.split()
-        domainPixels.append(thisLine)
-# Initialize a structured array to hold the pixel lat/lon and IDs
-domainPixelsArr = np.empty([len(domainPixels)],dtype=[('longitude',np.float32), ('latitude',np.float32), ('pixelId',np.dtype('U9'))])
-# Write the list data into the structured array
-for ll in range(len(domainPixels)):
-    domainPixelsArr[ll] = tuple(domainPixels[ll])
+domainPixelsArr = readDomain(domainFile)
+# Keep only the pixels of this run's tile
+tileIdx = getTileIdx(nTiles)
+tileTag = getTileTag(nTiles, tileIdx)
+domainPixelsArr = domainPixelsArr[getTilePixels(domainPixelsArr, nTiles, tileIdx)]
+if nTiles > 1:
+    print('Processing tile ' + str(tileIdx) + ' of 0-' + str(nTiles-1) + ' (' + str(len(domainPixelsArr)) + ' pixels)...')
+# Each tile writes its own store
+storeFn = getTileStoreFn(storeFn, tileTag)
+
+# Manifest of the days that have already been written
+manifest = readManifest(smapOutDir, outputFormat, tileTag)
+if manifest is None:
+    # Starting from scratch: record that nothing is committed before anything is written
+    checkNoOutput(smapOutDir, outputFormat, domainPixelsArr, storeFn=(storeFn if outputFormat == 'hdf5' else None))
+    manifest = newManifest(smapOutDir, outputFormat, domainPixelsArr, storeFn=(storeFn if outputFormat == 'hdf5' else None), tag=tileTag)
+    writeManifest(manifest, smapOutDir, sizes=manifest['sizes'])
+else:
+    checkManifest(manifest, domainPixelsArr)
+# Undo the writes of an interrupted batch (including the first one)
+rollbackToManifest(manifest, smapOutDir, domainPixelsArr)
+# Running statistics of the days already written (updated in place, see smapAggregate.py)
+aggregatesFn = getManifestAggregatesFn(manifest, smapOutDir)
+if aggregateFields is not None and aggregatesFn is None:
+    if manifest['lastDate'] is not None:
+        raise ValueError("The time series up to " + manifest['lastDate'] + " were written without statistics. Use another output directory to keep statistics.")
+    aggregatesFn = addManifestAggregates(manifest, smapOutDir, aggregateFields, aggregateGroups)
+aggregates = None if aggregatesFn is None else openAggregates(aggregatesFn)
+if aggregateFields is not None:
+    checkAggregates(aggregates, aggregateFields, aggregateGroups)
+elif aggregates is not None:
+    print('Updating the statistics kept by earlier runs (' + ', '.join(sorted(set(field for field, group in getAggregatePairs(aggregates)))) + ')...')
+# In update mode, read the days that are available, up to the last one
+availableDates = None
+if updateMode:
+    availableDates = getAvailableDates(smapDir, type=smapType)
+    if not availableDates:
+        raise FileNotFoundError("No SMAP files of " + smapType + " in " + smapDir + ".")
+    dateEnd = availableDates[-1] + dt.timedelta(days=1)
+# Skip the days that have already been written
+dateStart = getResumeDate(manifest, dateStart)
+if dateStart >= dateEnd:
+    print('Time series are up to date (last day written: ' + str(manifest['lastDate']) + ').')
+    sys.exit()
+print('Reading ' + dateStart.isoformat() + ' to ' + (dateEnd-dt.timedelta(days=1)).isoformat() + '...')
+
+# The 1-d lon/lat of the SMAP grid (computed once and cached in cacheDir)
+product = getProduct(smapType)
+lonData, latData = getGridLonLat(product['nLat'], product['nLon'], cacheDir=cacheDir)
+
 # The min and max lon and lat values in the domain. Allow some extra space to ensure the closest SMAP pixel is mapped to the NLDAS pixel, not just the closest in bounds SMAP pixel.
 minLon = np.min(domainPixelsArr['longitude'])-0.5
 maxLon = np.max(domainPixelsArr['longitude'])+0.5
 minLat = np.min(domainPixelsArr['latitude'])-0.5
 maxLat = np.max(domainPixelsArr['latitude'])+0.5
-# Trim the lon and lat data to the domain 
-trimmedLon = trim1d(lonData,minLon,maxLon)
-trimmedLat = trim1d(latData,minLat,maxLat)
+# Rows and columns of the SMAP grid that cover the domain. Only this window is read from each file.
+domainRows, domainCols = getTrimSlices(lonData,latData,minLon,maxLon,minLat,maxLat)
+# Trim the lon and lat data to the domain
+trimmedLon = lonData[domainCols]
+trimmedLat = latData[domainRows]
+# Select the appropriate SMAP pixel to pull data from for each domain pixel. This is the same for every batch.
+lonIdcs, latIdcs = selectSmapPixels(trimmedLon, trimmedLat, domainPixelsArr, cacheDir=cacheDir)
 
 # ----------------------------------------------------------------
 # Read SMAP data and save to array
 # Separate the total days into discrete batches to avoid running out of memory. We'll write each batch to disk before clearing that data from memory and going to the next one.
 
-# Initialize a value for the number of days left to read
-daysLeft = totDays
+# Memory that each day of a batch costs (the data of the domain pixels are pulled out of each file while it is read, see getSmapSmPixels), including the update of the statistics
+aggregateBytes = 0 if aggregates is None else estimateAggregateDayBytes(aggregates, len(domainPixelsArr))
+dayBytes = estimateDayBytes(len(trimmedLat), len(trimmedLon), len(domainPixelsArr), columnTypes, prefetch=prefetchBatches, text=(outputFormat == 'text'), gathered=True, aggregateBytes=aggregateBytes)
+# Number of days to read at once, and whether the batch data must be memory-mapped to fit in memory
+batchDays, spill = chooseBatchDays(memBudget, dayBytes, batchDays)
+# Dates to read (in update mode, only those with a SMAP file)
+readDates = [dates[0] for dates in getBatchDates(dateStart, dateEnd, 1, availableDates)]
+if len(readDates) < (dateEnd-dateStart).days:
+    print('Skipping ' + str((dateEnd-dateStart).days-len(readDates)) + ' days without a SMAP file.')
+batchDays = max(1, min(batchDays, len(readDates)))
+print('Reading ' + str(batchDays) + ' days per batch (about ' + str(round(batchDays*dayBytes/1024**2)) + ' MB)' + (', memory-mapped in ' + spillDir if spill else ''))
+# Dates of each batch of data to go through
+batchDates = getBatchDates(dateStart, dateEnd, batchDays, availableDates)
+# Number of batches of data to go through
+nBatches = len(batchDates)
 
-# Loop through each batch
-for bb in range(nBatches):
+# Time and bytes of each stage (see smapMetrics.py)
+metrics = newMetrics()
+lastMetrics = snapshotMetrics(metrics)
+profiler = startProfile(profileRun)
+nDaysTotal = len(readDates)
+nDaysDone = 0
+tStart = time.perf_counter()
+tBatch = tStart
+# Loop through each batch. The days are read (and the next batches prefetched) by the worker processes, which keep only the data of the domain pixels ([nPixels,nTime] columns).
+for bb, batchTs in enumerate(readBatches(batchDates, smapDir=smapDir, type=smapType, rows=domainRows, cols=domainCols, nWorkers=nWorkers, prefetch=prefetchBatches, spillDir=(spillDir if spill else None), qualityFilter=qualityFilter, metrics=metrics, pixels=(latIdcs, lonIdcs))):
     # Print batch number
-    print('Reading batch ' + str(bb+1) + ' of ' + str(nBatches) + '...')
-    # Initialize an empty array the same size as the lon/lat (plus an extra dimension for time) to hold this batch's data
-    batchSmapData = np.empty([len(trimmedLat), len(trimmedLon), np.min([batchDays, daysLeft])*2],dtype=dataTypes)
-    # Loop through each day in the batch
-    for dd in range(np.min([batchDays, daysLeft])):
-        # The date of this loop
-        thisDate = dateStart + dt.timedelta(days=dd+bb*batchDays)
-        print('Reading date ' + thisDate.isoformat() + '...')
-        # The SMAP hdf file name from this day
-        smapFn = getFn(date=thisDate, smapDir=smapDir, type='SMP')
-        # The SMAP data from that hdf file
-        fileSmapData = getSmapSm(fn=smapFn,am=True,pm=True)
-        # Trim the data to the domain
-        trimmedData = trimData3d(data=fileSmapData,lonData=lonData,latData=latData,minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
-        # Write the data to this batch's data
-        batchSmapData[:,:,(dd*2):(dd*2)+2] = trimmedData
-    # Write these data to a file corresponding to its pixel
-    for ff in range(len(domainPixelsArr)):
-        if ff <1:#% 1000 == 0:
-            #print('writing pixel ' + str(ff) + ' of ' + str(len(domainPixelsArr)))
-            #print(domainPixelsArr['pixelId'][ff])
-            # Name of file to write to
-            fName = smapOutDir + '/' + domainPixelsArr['pixelId'][ff] + '.txt'
-            # Select the appropriate SMAP pixel to pull data from
-            lonIdx, latIdx = selectSmapPixel(trimmedLon, trimmedLat, domainPixelsArr['longitude'][ff], domainPixelsArr['latitude'][ff])
-            # Pull data from SMAP array 
-            smapTs = batchSmapData[lonIdx,latIdx,:]
-            # Remove data without a lon value (indicates no retrieval)
-            smapTsClean = removeNoData(smapTs)
-            # Format data into a string 
-            bodyStr, headerStr = formatAsString(smapTsClean)
-            # Write the data to the file. Open with append 'a' mode. Close when done.(include header if first time writing--if file did not exist)
-            writeToFile(fName,bodyStr,headerStr)
-
-            # Clear smapData from memory
-
-    # Update daysLeft variable
-    daysLeft -= batchDays
+    print('Writing batch ' + str(bb+1) + ' of ' + str(nBatches) + '...')
+    # Write these data to a file corresponding to its pixel, or to the store
+    if outputFormat == 'text':
+        # The text writer uses the structured array of getFieldsAndDataTypes
+        with stageTimer(metrics, 'format'):
+            batchRecords = columnsToRecords(batchTs)
+        nBytes = writeBatchToText(smapOutDir, domainPixelsArr['pixelId'], batchRecords, metrics=metrics)
+        del batchRecords
+        nTime = None
+    elif outputFormat == 'hdf5':
+        with stageTimer(metrics, 'write', sizeOf(batchTs)):
+            createTsStore(storeFn, domainPixelsArr, columnTypes)
+            nTime = appendToTsStore(storeFn, batchTs, batchDates[bb])
+        nBytes = None
+    else:
+        raise NameError("Requested output format not supported.")
+    # Update the running statistics with this batch
+    if aggregates is not None:
+        with stageTimer(metrics, 'aggregate'):
+            updateAggregates(aggregates, batchTs, batchDates[bb])
+    # Commit the batch (and the update of the statistics)
+    with stageTimer(metrics, 'commit'):
+        commitBatch(manifest, smapOutDir, batchDates[bb], nBytes=nBytes, nTime=nTime, dateStart=dateStart)
+    # Report the stages of this batch (including the reading of its days before it was yielded), the throughput and the time left
+    now = time.perf_counter()
+    batchMetrics = diffMetrics(metrics, lastMetrics)
+    lastMetrics = snapshotMetrics(metrics)
+    nDaysDone += len(batchDates[bb])
+    print(batchSummary(batchMetrics, bb, nBatches, len(batchDates[bb]), len(domainPixelsArr), now-tBatch, now-tStart, nDaysDone, nDaysTotal))
+    logMetrics(metricsFn, {'record': 'batch', 'tile': tileTag, 'batch': bb+1, 'nBatches': nBatches, 'firstDate': batchDates[bb][0].isoformat(), 'lastDate': batchDates[bb][-1].isoformat(), 'nPixels': len(domainPixelsArr), 'seconds': {stage: values[0] for stage, values in batchMetrics.items()}, 'bytes': {stage: values[1] for stage, values in batchMetrics.items()}, 'batchSeconds': now-tBatch, 'elapsedSeconds': now-tStart, 'etaSeconds': (now-tStart)/nDaysDone*(nDaysTotal-nDaysDone)})
+    tBatch = now
+
+if aggregates is not None:
+    closeAggregates(aggregates)
+
+# Totals of the run
+elapsed = time.perf_counter() - tStart
+print('Done: ' + str(nDaysTotal) + ' days in {0:.2f} s ('.format(elapsed) + ', '.join(stage + ' {0:.2f} s'.format(values[0]) for stage, values in metrics.items()) + ').')
+logMetrics(metricsFn, {'record': 'run', 'tile': tileTag, 'firstDate': dateStart.isoformat(), 'lastDate': (dateEnd-dt.timedelta(days=1)).isoformat(), 'nPixels': len(domainPixelsArr), 'seconds': {stage: values[0] for stage, values in metrics.items()}, 'bytes': {stage: values[1] for stage, values in metrics.items()}, 'elapsedSeconds': elapsed})
+stopProfile(profiler, profileFn)
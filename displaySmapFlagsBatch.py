@@ -0,0 +1,117 @@
+#! /usr/local/other/SSS)_Ana-PyD/2.4.0_py3.5/bin/python
+
+'''
+This script will map SMAP flags for a range of days: one figure per day, pass (AM/PM) and flag, e.g. the QA maps of a month.
+The map (projection, coastlines, mesh of the grid and colorbar) is built once per worker process. Each frame then only replaces the data and the title of the mesh before it is saved.
+Each day is read once (only the window of the map and the flag fields) and only the mapped flags are decoded (a single AND over the flag field per flag, see decodeFlags). The days are rendered in parallel by nWorkers processes.
+Flag information found here:
+https://nsidc.org/data/smap/spl3smp/data-fields
+'''
+import datetime as dt
+import multiprocessing as mp
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from smapUtils import *
+from smapFlags import decodeFlags
+from smapProducts import getProduct
+from mpl_toolkits.basemap import Basemap
+
+# ----------------------------------------------------------------
+# Controls
+
+# Figure directory
+figDir = '../figures/'
+# SMAP directory
+smapDir = '../smapData'
+# SMAP product (see getProductTable in smapProducts.py)
+smapType = 'SMP'
+# Range of lon/lat to extract and display
+minLon = -125
+maxLon = -76
+minLat = 25
+maxLat = 50
+# Days to map: from dateStart up to (but not including) dateEnd. Days without a SMAP file are skipped.
+dateStart = dt.date(2015,4,1)
+dateEnd = dt.date(2015,5,1)
+# Passes to map ('AM' and/or 'PM')
+passes = ['AM']
+# Flags to map: (flag field, flag name) pairs (see getFlagTable in smapFlags.py)
+flags = [('surface_flag', 'static_water'), ('surface_flag', 'mountainous_terrain'), ('surface_flag', 'dense_vegetation'), ('surface_flag', 'coastal_proximity'), ('retrieval_qual_flag', 'not_recommended_quality')]
+# Number of worker processes rendering the days (0 renders them one after the other in this process)
+nWorkers = 4
+# Figure size
+width = 10
+height = 6
+
+# ----------------------------------------------------------------
+# Functions
+
+# The map of this process (see initRenderer)
+renderer = {}
+
+# Function to build the map once per process: the projection, the coastlines, the mesh of the window of the grid (without data) and the colorbar
+def initRenderer():
+    mm = Basemap(projection='cyl', llcrnrlat=minLat, urcrnrlat=maxLat, llcrnrlon=minLon, urcrnrlon=maxLon, resolution='l', lon_0=0) # Available 'c','l','i','h','f'
+    fig = plt.figure(figsize=(width, height))
+    mesh = mm.pcolormesh(pLon, pLat, np.ma.masked_all(meshShape), vmin=0, vmax=1)
+    mm.drawcoastlines()
+    fig.colorbar(mesh, ticks=[0, 1])
+    title = plt.title('')
+    renderer.update(fig=fig, mesh=mesh, title=title)
+
+# Function to map the flags of one day. Returns the names of the figures written.
+def renderDay(date):
+    fileName = getFn(date=date, smapDir=smapDir, type=smapType)
+    if not Path(fileName).is_file():
+        return []
+    # Read the window once, with only the flag fields (and the lon, which tells where there is no retrieval)
+    flagFields = sorted(set(field for field, name in flags))
+    data = getSmapSmColumns(fn=fileName, am=('AM' in passes), pm=('PM' in passes), rows=rows, cols=cols, fields=['longitude']+flagFields, type=smapType)
+    # Decode the mapped flags
+    dayFlags = decodeFlags(data, {field: [name for flagField, name in flags if flagField == field] for field in flagFields})
+    noData = data['longitude'] == -9999.0
+    figFns = []
+    for pp, passName in enumerate(['AM', 'PM']):
+        if passName not in passes:
+            continue
+        for field, name in flags:
+            # Replace the data of the mesh (cells without a retrieval are not drawn) and the title, then save the frame
+            values = np.ma.masked_array(dayFlags[field][name][:,:,pp].astype(np.uint8), mask=noData[:,:,pp])
+            renderer['mesh'].set_array(values.ravel())
+            renderer['title'].set_text(name + ' (' + field + '), ' + date.isoformat() + ' ' + passName)
+            figFn = figDir + name + '_' + date.strftime('%Y%m%d') + '_' + passName + '.png'
+            renderer['fig'].savefig(figFn, bbox_inches='tight')
+            figFns.append(figFn)
+    return figFns
+
+# ----------------------------------------------------------------
+# Render the maps
+
+# Window of the grid to map, and the lon/lat of the mesh (the same for every day)
+product = getProduct(smapType)
+lonData, latData = getGridLonLat(product['nLat'], product['nLon'])
+rows, cols = getTrimSlices(lonData,latData,minLon,maxLon,minLat,maxLat)
+meshShape = (len(latData[rows]), len(lonData[cols]))
+pLon, pLat = processLatLon(mapObj=None,cLon=lonData,cLat=latData,minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
+
+dates = [dateStart + dt.timedelta(days=dd) for dd in range((dateEnd-dateStart).days)]
+Path(figDir).mkdir(parents=True, exist_ok=True)
+print('Mapping ' + str(len(flags)) + ' flags for ' + str(len(dates)) + ' days in ' + figDir + '...')
+if nWorkers < 1:
+    initRenderer()
+    dayFigFns = map(renderDay, dates)
+else:
+    # The map is built once in each worker. The script is not guarded by __main__, so the workers must be forked rather than spawned.
+    pool = ProcessPoolExecutor(max_workers=nWorkers, mp_context=mp.get_context('fork'), initializer=initRenderer)
+    dayFigFns = pool.map(renderDay, dates)
+nFigs = 0
+for date, figFns in zip(dates, dayFigFns):
+    print('Mapped ' + date.isoformat() + ' (' + str(len(figFns)) + ' figures)')
+    nFigs += len(figFns)
+if nWorkers >= 1:
+    pool.shutdown()
+print('Wrote ' + str(nFigs) + ' figures.')
@@ -8,11 +8,11 @@ Flag information found here:
 https://nsidc.org/data/smap/spl3smp/data-fields
 '''
 import datetime as dt
-import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from smapUtils import *
+from smapFlags import decodeFlags
 from mpl_toolkits.basemap import Basemap
 #from pjsFunctions import enlargeLonLat
 
@@ -46,23 +46,27 @@ data = nanfill(data,nanval=-9999.,fieldName='latitude')
 data = nanfill(data,nanval=-9999.,fieldName='soil_moisture')
 data = nanfill(data,nanval=-9999.,fieldName='tb_v_corrected')
 data = nanfill(data,nanval=-9999.,fieldName='vegetation_water_content')
+# 1-d lon/lat of the SMAP grid
+lonData, latData = getGridLonLat()
 # Trim the data to requested domain
-trimmedData = trimData(data=data,lonData=np.nanmean(data['longitude'],axis=0),latData=np.nanmean(data['latitude'],axis=1),minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
+trimmedData = trimData(data=data,lonData=lonData,latData=latData,minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
+# Decode the flags to display
+flags = decodeFlags(trimmedData, {'retrieval_qual_flag': ['not_recommended_quality'], 'surface_flag': ['mountainous_terrain', 'dense_vegetation', 'coastal_proximity', 'static_water']})
 # Data flagged for uncertain quality
-uncertainQual = bitVal(trimmedData['retrieval_qual_flag'],qBit=0)
+uncertainQual = flags['retrieval_qual_flag']['not_recommended_quality']
 # Data flagged for mountainous terrain
-mountains = bitVal(trimmedData['surface_flag'],qBit=9)
+mountains = flags['surface_flag']['mountainous_terrain']
 # Data flagged for dense vegetation
-denseVeg = bitVal(trimmedData['surface_flag'],qBit=10)
+denseVeg = flags['surface_flag']['dense_vegetation']
 # Data flagged for coastal proximity 
-coastalProx = bitVal(trimmedData['surface_flag'],qBit=2)
+coastalProx = flags['surface_flag']['coastal_proximity']
 # Data flagged for static water
-staticWater = bitVal(trimmedData['surface_flag'],qBit=0)
+staticWater = flags['surface_flag']['static_water']
 
 # Set up map projection 
 mm = Basemap(projection='cyl', llcrnrlat=minLatDisp, urcrnrlat=maxLatDisp, llcrnrlon=minLonDisp, urcrnrlon=maxLonDisp, resolution='l', lon_0=0) # Available 'c','l','i','h','f'  
 # Convert lon and lat to proper values for plotting
-pLon, pLat = processLatLon(mapObj=mm,cLon=data['longitude'],cLat=data['latitude'],minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
+pLon, pLat = processLatLon(mapObj=mm,cLon=lonData,cLat=latData,minLon=minLon,maxLon=maxLon,minLat=minLat,maxLat=maxLat)
 
 # Plot 
 # Figure size
@@ -0,0 +1,19 @@
+# This script will export the SMAP time series store written by createTimeseries.py (outputFormat = 'hdf5') to the legacy format of one text file per pixel.
+
+from smapStore import exportTsStoreToText
+
+# ----------------------------------------------------------------
+# Controls
+
+# Store to export
+storeFn = '../../data/smapTs/smapTs.h5'
+# Directory where the text files will be written (existing files are overwritten)
+smapOutDir = '../../data/smapTs'
+# Retrievals to leave out: a dict of flag field -> list of flag names (see getFlagTable in smapFlags.py), or None to export every retrieval
+qualityFilter = None
+
+# ----------------------------------------------------------------
+# Export
+
+print('Exporting ' + storeFn + ' to ' + smapOutDir + '...')
+exportTsStoreToText(storeFn, smapOutDir, qualityFilter=qualityFilter)
@@ -0,0 +1,44 @@
+# This script will check and combine the output of a domain that was processed in tiles by createTimeseries.py (nTiles > 1).
+# Every tile must have been committed up to the same days. Text files are already written per pixel, so only the manifest of the whole domain is written; stores of the tiles are merged into one store.
+# Use the same controls as the createTimeseries.py runs of the tiles.
+
+from smapUtils import readDomain, getTilePixels, getTileTag
+from smapStore import getTileStoreFn, mergeTsStores
+from smapManifest import checkTileManifests, writeMergedManifest
+
+# ----------------------------------------------------------------
+# Controls
+
+# Lon/Lat pairs of the domain (written by createDomain.py: .npy, .h5 or text; if the .npy file does not exist, the .txt file of the same name is read)
+domainFile = 'nldasDomainSection.npy'
+# Directory where the tiles wrote their time series
+smapOutDir = '../../data/smapTs'
+# Format of the time series: 'text' or 'hdf5'
+outputFormat = 'text'
+# Name of the (merged) store when outputFormat is 'hdf5'
+storeFn = smapOutDir + '/smapTs.h5'
+# Number of tiles the domain was split into
+nTiles = 4
+
+# ----------------------------------------------------------------
+# Merge
+
+# The pixels of each tile
+domainPixelsArr = readDomain(domainFile)
+tilePixels = [getTilePixels(domainPixelsArr, nTiles, tt) for tt in range(nTiles)]
+tileTags = [getTileTag(nTiles, tt) for tt in range(nTiles)]
+# Check that the tiles cover the domain
+nCovered = len(set().union(*[set(pixelIdcs.tolist()) for pixelIdcs in tilePixels]))
+if nCovered != len(domainPixelsArr):
+    raise ValueError("The tiles cover " + str(nCovered) + " of the " + str(len(domainPixelsArr)) + " domain pixels.")
+# Check that every tile has been committed up to the same days
+manifests = checkTileManifests(smapOutDir, outputFormat, domainPixelsArr, tilePixels, tileTags)
+print('All ' + str(nTiles) + ' tiles hold ' + manifests[0]['firstDate'] + ' to ' + manifests[0]['lastDate'] + '.')
+# Merge the stores
+if outputFormat == 'hdf5':
+    print('Merging the stores of the tiles into ' + storeFn + '...')
+    mergeTsStores(storeFn, domainPixelsArr, [getTileStoreFn(storeFn, tag) for tag in tileTags], tilePixels)
+# Write the manifest of the domain (merging the running statistics of the tiles, if they were kept)
+if manifests[0]['aggregatesFile'] is not None:
+    print('Merging the statistics of the tiles...')
+writeMergedManifest(smapOutDir, outputFormat, domainPixelsArr, tilePixels, manifests, storeFn=(storeFn if outputFormat == 'hdf5' else None))
@@ -0,0 +1,42 @@
+# This script will pull the time series of some pixels out of the HDF5 store written by createTimeseries.py (outputFormat = 'hdf5') and save them as numpy arrays (.npz), e.g. for a model calibration job.
+# Only the chunks of the store that hold the requested pixels and dates are read (see smapQuery.py).
+
+import datetime as dt
+import numpy as np
+from smapUtils import readDomain
+from smapQuery import openTsQuery, closeTsQuery, getPixelIdcs, getBoxPixelIdcs, queryPixels
+
+# ----------------------------------------------------------------
+# Controls
+
+# Store to read
+smapOutDir = '../../data/smapTs'
+storeFn = smapOutDir + '/smapTs.h5'
+# Days to read: the retrievals from dateStart up to (but not including) dateEnd, by the UTC day of their tb_time_utc (None for no bound)
+dateStart = dt.date(2015,3,31)
+dateEnd = dt.date(2015,4,8)
+# Pixels to read: the pixels of a domain file (see createDomain.py), or else the pixels in a lon/lat box (minLon,maxLon,minLat,maxLat)
+queryDomainFile = None
+box = (-100, -98, 35, 37)
+# Fields to read (None for every field, see getColumnDataTypes)
+fields = ['tb_time_utc', 'soil_moisture', 'retrieval_qual_flag', 'localTime']
+# File where the pixelIds, the days and a [nPixels,nTime] array per field are saved
+outFn = smapOutDir + '/query.npz'
+
+# ----------------------------------------------------------------
+# Query the store
+
+query = openTsQuery(storeFn)
+# Positions of the requested pixels in the store
+if queryDomainFile is not None:
+    pixelIdcs = getPixelIdcs(query, readDomain(queryDomainFile)['pixelId'])
+else:
+    pixelIdcs = getBoxPixelIdcs(query, *box)
+print('Reading ' + str(len(pixelIdcs)) + ' pixels from ' + storeFn + '...')
+tsData, days = queryPixels(query, pixelIdcs, dateStart, dateEnd, fields)
+pixelIds = query['pixelIds'][pixelIdcs]
+closeTsQuery(query)
+
+# Save the arrays
+print('Saving ' + str(len(days)) + ' time steps to ' + outFn + '...')
+np.savez(outFn, pixelId=pixelIds, day=days, **tsData)
@@ -0,0 +1,279 @@
+'''
+This file contains functions that keep running statistics of the time series (count, mean, variance, min and max of each pixel) while they are written, so that monthly means, climatologies and anomalies do not need a second pass over the time series.
+The statistics of a field are kept per group of time steps: 'total' (all time steps), 'month' (each calendar month of the record, e.g. 2015-04), 'monthOfYear' (1-12, all years together) and 'dayOfYear' (1-366, all years together). The time steps are grouped by the day of the SMAP file they come from (the 'day' of the store).
+Each batch is reduced to its own statistics and merged into the running ones with the pairwise update of Chan et al. (count, mean and sum of squared differences from the mean), which is exact and numerically stable, and lets statistics of different days (e.g. of separate runs) be merged the same way.
+The statistics are kept in an HDF5 file (one [nPixels,nKeys] dataset per statistic, chunked by key) that is updated in place: a batch only reads and rewrites the columns of its own keys (e.g. a column per day of year), never the whole file. The old values of those columns are saved first, so that the update of a batch that is not committed (see commitBatch in smapManifest.py) can be rolled back.
+'''
+import h5py as h5
+import numpy as np
+import os
+from smapUtils import getColumnFillValues
+
+# Function to get the names of the statistics that are kept (per pixel and group key)
+def getStatNames():
+    return ['count', 'mean', 'm2', 'min', 'max']
+
+# Function to get the groups of time steps that statistics can be kept for
+def getAggregateGroups():
+    return ['total', 'month', 'monthOfYear', 'dayOfYear']
+
+# Function to return the key of the group of each day (datetime64[D] array): 0 for 'total', months since 1970-01 for 'month', 1-12 for 'monthOfYear' and 1-366 for 'dayOfYear'
+def getGroupKeys(days, group):
+    days = np.asarray(days, dtype='datetime64[D]')
+    if group == 'total':
+        return np.zeros(days.shape, dtype=np.int64)
+    months = days.astype('datetime64[M]')
+    if group == 'month':
+        return months.astype(np.int64)
+    if group == 'monthOfYear':
+        return months.astype(np.int64) % 12 + 1
+    if group == 'dayOfYear':
+        return (days - days.astype('datetime64[Y]')).astype(np.int64) + 1
+    raise NameError("Unknown aggregate group: " + group)
+
+# Function to create empty statistics for nPixels pixels (no group keys yet)
+def emptyStats(nPixels):
+    return {'keys': np.zeros([0], dtype=np.int64), 'count': np.zeros([nPixels,0], dtype=np.int64), 'mean': np.zeros([nPixels,0]), 'm2': np.zeros([nPixels,0]), 'min': np.zeros([nPixels,0]), 'max': np.zeros([nPixels,0])}
+
+# Function to create the file of the statistics of nPixels pixels (field -> group -> statistics, without any key yet). nBatches is the number of batches committed before the statistics start (see rollbackAggregates).
+def createAggregates(fn, nPixels, fields, groups=None, nBatches=0, chunkPixels=16384):
+    if groups is None:
+        groups = getAggregateGroups()
+    tmpFn = str(fn) + '.tmp'
+    with h5.File(tmpFn, 'w') as ff:
+        ff.attrs['nPixels'] = nPixels
+        ff.attrs['nBatches'] = nBatches
+        for field in fields:
+            for group in groups:
+                grp = ff.create_group(field + '/' + group)
+                grp.create_dataset('keys', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(366,))
+                # One chunk per key column, so that a column is read and rewritten without touching the others
+                for name in getStatNames():
+                    grp.create_dataset(name, shape=(nPixels,0), maxshape=(None,None), dtype=(np.int64 if name == 'count' else np.float64), chunks=(max(1, min(nPixels, chunkPixels)), 1))
+    os.replace(tmpFn, fn)
+
+# Function to open the file of the statistics to update them. Returns the handle: a dict with the open file. Close it with closeAggregates.
+def openAggregates(fn):
+    return {'file': h5.File(fn, 'a'), 'fn': str(fn)}
+
+# Function to close the handle of the statistics
+def closeAggregates(aggregates):
+    aggregates['file'].close()
+
+# Function to return the (field, group) pairs of the statistics kept in a file
+def getAggregatePairs(aggregates):
+    ff = aggregates['file']
+    return [(field, group) for field in ff if field != 'undo' for group in ff[field]]
+
+# Function to read columns (sorted positions on the key axis) of a statistic
+def readColumns(ds, cols):
+    if len(cols) == 0:
+        return np.zeros([ds.shape[0], 0], dtype=ds.dtype)
+    return ds[:, np.asarray(cols)]
+
+# Function to write columns (positions on the key axis, in any order) of a statistic
+def writeColumns(ds, cols, values):
+    if len(cols) == 0:
+        return
+    order = np.argsort(cols)
+    ds[:, np.asarray(cols)[order]] = values[:, order]
+
+# Function to compute the statistics of the values ([nPixels,nTime]) of each group key (keys: the key of each time step). valid ([nPixels,nTime] boolean) marks the values to use.
+def batchStats(values, valid, keys):
+    uniqueKeys = np.unique(keys)
+    nPixels = values.shape[0]
+    stats = {'keys': uniqueKeys}
+    for name in getStatNames():
+        stats[name] = np.zeros([nPixels, len(uniqueKeys)], dtype=(np.int64 if name == 'count' else np.float64))
+    values = np.where(valid, values, np.nan).astype(np.float64)
+    for kk, key in enumerate(uniqueKeys):
+        keyValues = values[:, keys == key]
+        count = valid[:, keys == key].sum(axis=1)
+        has = count > 0
+        stats['count'][:,kk] = count
+        # Pixels without a valid value keep zeros (they are ignored when merging)
+        stats['mean'][has,kk] = np.nanmean(keyValues[has], axis=1)
+        stats['m2'][has,kk] = np.nansum((keyValues[has] - stats['mean'][has,kk][:,None])**2, axis=1)
+        stats['min'][has,kk] = np.nanmin(keyValues[has], axis=1)
+        stats['max'][has,kk] = np.nanmax(keyValues[has], axis=1)
+    return stats
+
+# Function to add the (missing) keys to statistics, as empty columns. Returns the statistics with their columns in the order of keys (which must be sorted and include the keys the statistics have).
+def expandStats(stats, keys):
+    if np.array_equal(stats['keys'], keys):
+        return stats
+    cols = np.searchsorted(keys, stats['keys'])
+    expanded = {'keys': keys}
+    for name in getStatNames():
+        expanded[name] = np.zeros([stats[name].shape[0], len(keys)], dtype=stats[name].dtype)
+        expanded[name][:,cols] = stats[name]
+    return expanded
+
+# Function to merge two statistics of the same pixels computed from different time steps (Chan et al. pairwise update)
+def mergeStats(statsA, statsB):
+    keys = np.union1d(statsA['keys'], statsB['keys'])
+    aa = expandStats(statsA, keys)
+    bb = expandStats(statsB, keys)
+    count = aa['count'] + bb['count']
+    merged = {'keys': keys, 'count': count}
+    # Weight of B in the merged mean (0 where neither has a value)
+    weightB = np.divide(bb['count'], count, out=np.zeros(count.shape), where=count > 0)
+    delta = bb['mean'] - aa['mean']
+    merged['mean'] = aa['mean'] + delta*weightB
+    merged['m2'] = aa['m2'] + bb['m2'] + delta**2*aa['count']*weightB
+    # Min and max of the values of both (only one of them may have values)
+    merged['min'] = np.where(aa['count'] == 0, bb['min'], np.where(bb['count'] == 0, aa['min'], np.minimum(aa['min'], bb['min'])))
+    merged['max'] = np.where(aa['count'] == 0, bb['max'], np.where(bb['count'] == 0, aa['max'], np.maximum(aa['max'], bb['max'])))
+    return merged
+
+# Function to update the statistics with a batch of data (see readBatches in smapUtils: [nPixels,2*nDays] columns, am and pm of each of the dates). Values that are fill values (no retrieval, or rejected by the quality filter) are left out.
+def updateAggregates(aggregates, batchTs, dates):
+    '''
+    Only the columns of the keys of the batch are read and rewritten (keys seen for the first time are appended).
+    The old values of those columns are saved first (in the 'undo' group), and the file then counts one more batch than the manifest until the batch is committed. If the batch is not committed, rollbackAggregates puts the old values back.
+    '''
+    ff = aggregates['file']
+    fillValues = getColumnFillValues()
+    days = np.repeat(np.array(dates, dtype='datetime64[D]'), 2)
+    # The statistics of the batch, and the columns of their keys in the file
+    updates = []
+    for field, group in getAggregatePairs(aggregates):
+        values = batchTs[field]
+        valid = (values != fillValues[field]) & np.isfinite(values)
+        grp = ff[field][group]
+        stats = batchStats(values, valid, getGroupKeys(days, group))
+        keyCols = {key: kk for kk, key in enumerate(grp['keys'][()].tolist())}
+        cols = np.array([keyCols.get(key, -1) for key in stats['keys'].tolist()], dtype=np.int64)
+        isNew = cols < 0
+        cols[isNew] = len(keyCols) + np.arange(isNew.sum())
+        updates.append((field + '/' + group, stats, cols, isNew, len(keyCols)))
+    # Save the old values of the columns, then count the batch
+    if 'undo' in ff:
+        del ff['undo']
+    for path, stats, cols, isNew, nKeys in updates:
+        undoGrp = ff.create_group('undo/' + path)
+        undoGrp.attrs['nKeys'] = nKeys
+        oldCols = np.sort(cols[~isNew])
+        undoGrp.create_dataset('cols', data=oldCols)
+        for name in getStatNames():
+            undoGrp.create_dataset(name, data=readColumns(ff[path][name], oldCols))
+    ff.flush()
+    ff.attrs['nBatches'] = ff.attrs['nBatches'] + 1
+    ff.flush()
+    # Merge the batch into the columns of its keys
+    for path, stats, cols, isNew, nKeys in updates:
+        grp = ff[path]
+        old = expandStats(emptyStats(stats['count'].shape[0]), stats['keys'])
+        oldCols = cols[~isNew]
+        order = np.argsort(oldCols)
+        for name in getStatNames():
+            old[name][:, np.flatnonzero(~isNew)[order]] = readColumns(grp[name], oldCols[order])
+        merged = mergeStats(old, stats)
+        # Append the new keys
+        if isNew.any():
+            nNew = nKeys + isNew.sum()
+            grp['keys'].resize((nNew,))
+            grp['keys'][nKeys:nNew] = stats['keys'][isNew]
+            for name in getStatNames():
+                grp[name].resize(nNew, axis=1)
+        for name in getStatNames():
+            writeColumns(grp[name], cols, merged[name])
+    ff.flush()
+
+# Function to roll the statistics back to nBatches committed batches (see commitBatch in smapManifest.py): if they were updated with a batch that was not committed, the columns it changed get their old values back
+def rollbackAggregates(aggregates, nBatches):
+    ff = aggregates['file']
+    if ff.attrs['nBatches'] == nBatches:
+        return
+    if ff.attrs['nBatches'] != nBatches+1 or 'undo' not in ff:
+        raise ValueError("The statistics in " + aggregates['fn'] + " hold " + str(ff.attrs['nBatches']) + " batches but " + str(nBatches) + " are committed, and cannot be rolled back.")
+    undo = ff['undo']
+    for field in undo:
+        for group in undo[field]:
+            undoGrp = undo[field][group]
+            grp = ff[field][group]
+            nKeys = undoGrp.attrs['nKeys']
+            for name in getStatNames():
+                writeColumns(grp[name], undoGrp['cols'][()], undoGrp[name][()])
+                grp[name].resize(nKeys, axis=1)
+            grp['keys'].resize((nKeys,))
+    ff.attrs['nBatches'] = nBatches
+    ff.flush()
+
+# Function to estimate the memory (bytes) that the statistics cost per day of a batch of nPixels pixels (see estimateDayBytes in smapUtils): a float copy and the mask of the values of each field, and for each (field, group) at most one column per day, held as the statistics of the batch, the old and the merged statistics, the saved old values and the temporaries of the merge
+def estimateAggregateDayBytes(aggregates, nPixels):
+    pairs = getAggregatePairs(aggregates)
+    nFields = len(set(field for field, group in pairs))
+    return nPixels*(nFields*2*(8+8+1) + len(pairs)*len(getStatNames())*8*5)
+
+# Function to write the statistics of a domain (nPixels pixels, nBatches committed batches) to fn from the statistics files of its tiles (see getTilePixels in smapUtils), one key column at a time
+def mergeTileAggregates(fn, tileFns, tilePixels, nPixels, nBatches):
+    tiles = [openAggregates(tileFn) for tileFn in tileFns]
+    pairs = getAggregatePairs(tiles[0])
+    createAggregates(fn, nPixels, [], [], nBatches)
+    with h5.File(fn, 'a') as ff:
+        for field, group in pairs:
+            tileKeys = [tile['file'][field][group]['keys'][()] for tile in tiles]
+            keys = np.unique(np.concatenate(tileKeys))
+            grp = ff.create_group(field + '/' + group)
+            grp.create_dataset('keys', data=keys, maxshape=(None,), chunks=(366,))
+            for name in getStatNames():
+                tileDs = [tile['file'][field][group][name] for tile in tiles]
+                ds = grp.create_dataset(name, shape=(nPixels,len(keys)), maxshape=(None,None), dtype=tileDs[0].dtype, chunks=(max(1, min(nPixels, 16384)), 1))
+                for kk, key in enumerate(keys):
+                    column = np.zeros([nPixels], dtype=ds.dtype)
+                    for tileDsKeys, tileData, pixelIdcs in zip(tileKeys, tileDs, tilePixels):
+                        tileCols = np.flatnonzero(tileDsKeys == key)
+                        if len(tileCols):
+                            column[pixelIdcs] = tileData[:, tileCols[0]]
+                    ds[:, kk] = column
+    for tile in tiles:
+        closeAggregates(tile)
+
+# Function to get the mean, variance (sample variance, NaN with fewer than 2 values), min and max of a field for a group of the statistics (as read by readAggregates). Returns the keys of the group and a dict of [nPixels,nKeys] arrays (NaN where there is no value).
+def getAggregateProducts(aggregates, field, group='total'):
+    stats = aggregates[field][group]
+    has = stats['count'] > 0
+    products = {'count': stats['count']}
+    products['mean'] = np.where(has, stats['mean'], np.nan)
+    products['variance'] = np.divide(stats['m2'], stats['count']-1, out=np.full(stats['m2'].shape, np.nan), where=stats['count'] > 1)
+    products['min'] = np.where(has, stats['min'], np.nan)
+    products['max'] = np.where(has, stats['max'], np.nan)
+    return stats['keys'], products
+
+# Function to get the anomalies of data ([nPixels,nTime] values of a field, with the day of each time step) from the climatology of a group of the aggregates ('monthOfYear' or 'dayOfYear'). NaN where there is no climatology or no value.
+def getAnomalies(aggregates, field, values, days, group='dayOfYear'):
+    keys, products = getAggregateProducts(aggregates, field, group)
+    stepKeys = getGroupKeys(days, group)
+    cols = np.searchsorted(keys, stepKeys)
+    cols = np.minimum(cols, max(len(keys)-1, 0))
+    known = (keys[cols] == stepKeys) if len(keys) else np.zeros(stepKeys.shape, dtype=bool)
+    climatology = np.full(np.shape(values), np.nan)
+    climatology[:,known] = products['mean'][:,cols[known]]
+    valid = np.asarray(values) != getColumnFillValues()[field]
+    return np.where(valid, values - climatology, np.nan)
+
+# Function to read the statistics of a file (or of some of its fields) into memory: a dict of field -> group -> statistics, with the keys sorted (see getAggregateProducts)
+def readAggregates(fn, fields=None):
+    aggregates = {}
+    with h5.File(fn, 'r') as ff:
+        for field in ff:
+            if field == 'undo' or (fields is not None and field not in fields):
+                continue
+            aggregates[field] = {}
+            for group in ff[field]:
+                keys = ff[field][group]['keys'][()]
+                order = np.argsort(keys)
+                aggregates[field][group] = {'keys': keys[order]}
+                for name in getStatNames():
+                    aggregates[field][group][name] = ff[field][group][name][()][:,order]
+    return aggregates
+
+# Function to check that the statistics keep the requested fields and groups
+def checkAggregates(aggregates, fields, groups=None):
+    if groups is None:
+        groups = getAggregateGroups()
+    kept = sorted(getAggregatePairs(aggregates))
+    requested = sorted((field, group) for field in fields for group in groups)
+    if kept != requested:
+        raise ValueError("The statistics of the output directory keep other fields or groups (" + ', '.join(field + '/' + group for field, group in kept) + ") than the ones requested.")
@@ -0,0 +1,34 @@
+'''
+This file contains functions that write files atomically, for the manifests of the output and the caches that several runs (e.g. the tiles of an array job) share.
+A file is written to a temporary file of its own in the same directory and then moved over the target, so readers see either the previous file or the complete new one, and concurrent writers of the same file never use the same temporary file.
+'''
+import os
+import tempfile
+import numpy as np
+from pathlib import Path
+
+# Function to write a file atomically: writeFunc writes the contents to an open binary file, which then replaces fn
+def atomicWrite(fn, writeFunc):
+    fn = Path(fn)
+    fid = tempfile.NamedTemporaryFile(dir=fn.parent, prefix=fn.name + '.', suffix='.tmp', delete=False)
+    try:
+        with fid:
+            writeFunc(fid)
+            fid.flush()
+            os.fsync(fid.fileno())
+        os.replace(fid.name, fn)
+    except BaseException:
+        Path(fid.name).unlink(missing_ok=True)
+        raise
+
+# Function to read the arrays (a dict of name -> array) of a cache file, or None if it has not been written yet
+def readCache(cacheFn):
+    if not Path(cacheFn).is_file():
+        return None
+    with np.load(cacheFn) as cached:
+        return {name: cached[name] for name in cached.files}
+
+# Function to save arrays (name=array) to a cache file, creating its directory. The file is always complete, even when several processes write it at once.
+def writeCache(cacheFn, **arrays):
+    Path(cacheFn).parent.mkdir(parents=True, exist_ok=True)
+    atomicWrite(cacheFn, lambda fid: np.savez(fid, **arrays))
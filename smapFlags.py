@@ -0,0 +1,99 @@
+'''
+This file contains functions that are used to decode the quality and surface flags of the SMAP data
+Flag information found here:
+https://nsidc.org/data/smap/spl3smp/data-fields
+A raised bit (1) means the condition is flagged, e.g. retrieval_qual_flag bit 0 raised means the retrieval does NOT have recommended quality.
+'''
+import numpy as np
+
+# Function to get the named bits of each flag field
+def getFlagTable():
+    flagTable = {
+        'retrieval_qual_flag': {
+            'not_recommended_quality': 0,
+            'retrieval_not_attempted': 1,
+            'retrieval_failed': 2,
+            'freeze_thaw_retrieval_failed': 3,
+        },
+        'surface_flag': {
+            'static_water': 0,
+            'radar_water': 1,
+            'coastal_proximity': 2,
+            'urban_area': 3,
+            'precipitation': 4,
+            'snow_or_ice': 5,
+            'permanent_snow_or_ice': 6,
+            'frozen_ground_radiometer': 7,
+            'frozen_ground_model': 8,
+            'mountainous_terrain': 9,
+            'dense_vegetation': 10,
+            'nadir_region': 11,
+        },
+        'tb_qual_flag_v': {
+            'tb_quality': 0,
+            'tb_range': 1,
+            'rfi_detected': 2,
+            'rfi_corrected': 3,
+            'nedt': 4,
+            'direct_sun': 5,
+            'reflected_sun': 6,
+            'reflected_moon': 7,
+            'direct_galaxy': 8,
+            'reflected_galaxy': 9,
+            'atmosphere': 10,
+            'faraday_rotation': 11,
+            'null_value': 12,
+        },
+    }
+    return flagTable
+
+# Function to get the values of a flag field as integers. Flags read with NaN fill come as floats; NaN has no flag raised.
+def getFlagValues(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), 0, values).astype(np.uint16)
+    return values
+
+# Function to decode the requested flags of the flag fields. data is a structured array or a dict of columns that holds the flag fields.
+def decodeFlags(data, flags=None):
+    '''
+    flags is a dict of flag field -> list of flag names (see getFlagTable), as for flaggedMask. Default: every named flag of every flag field.
+    Returns a dict (per flag field) of dicts (per requested flag name) of boolean arrays with the shape of the data that are True where the flag is raised.
+    The flag fields stay as they are (2 bytes per value); each requested flag costs a single AND over its field (see anyFlagRaised) and one byte per value, so only the flags that are used are paid for.
+    '''
+    flagTable = getFlagTable()
+    if flags is None:
+        flags = {field: list(names) for field, names in flagTable.items()}
+    decoded = {}
+    for field, names in flags.items():
+        values = getFlagValues(data[field])
+        decoded[field] = {name: anyFlagRaised(values, flagMask(field, [name])) for name in names}
+    return decoded
+
+# Function to get the integer mask of the named flags of a flag field
+def flagMask(field, names):
+    flagTable = getFlagTable()
+    unknown = set(names) - set(flagTable[field])
+    if unknown:
+        raise NameError("Unknown " + field + " flags: " + ', '.join(sorted(unknown)))
+    mask = 0
+    for name in names:
+        mask |= 1 << flagTable[field][name]
+    return mask
+
+# Function to find where any of the flags of a combined flagMask are raised (a single pass over the values)
+def anyFlagRaised(values, mask):
+    return (np.asarray(values) & mask) != 0
+
+# Function to find where any of the given flags are raised. rejectFlags is a dict of flag field -> list of flag names (or integer mask). A single pass over each field.
+def flaggedMask(data, rejectFlags):
+    flagged = None
+    for field, names in rejectFlags.items():
+        mask = names if isinstance(names, (int, np.integer)) else flagMask(field, names)
+        fieldFlagged = anyFlagRaised(data[field], mask)
+        flagged = fieldFlagged if flagged is None else (flagged | fieldFlagged)
+    return flagged
+
+# Function to find the retrievals with recommended quality (retrieval_qual_flag bit 0 not raised)
+def recommendedQuality(data):
+    return ~flaggedMask(data, {'retrieval_qual_flag': ['not_recommended_quality']})
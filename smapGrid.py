@@ -0,0 +1,46 @@
+'''
+This file contains functions that describe the grid of the SMAP data: the global cylindrical EASE-Grid 2.0 (WGS84 ellipsoid, true scale at 30 N/S)
+Grid information found here:
+https://nsidc.org/data/user-resources/help-center/guide-ease-grids
+'''
+import numpy as np
+from pathlib import Path
+from smapFiles import readCache, writeCache
+
+# Function to compute the lon and lat (degrees) of the centers of the columns and rows of the global EASE-Grid 2.0 with nLat rows and nLon columns (406x964 for the 36 km grid, 1624x3856 for the 9 km grid). Rows go from north to south.
+def easeGridLonLat(nLat=406, nLon=964):
+    # WGS84 semi-major axis (m) and eccentricity
+    aa = 6378137.0
+    ee = 0.081819190842622
+    # Scale factor along the parallels at the standard parallel (30 degrees)
+    sinPhi1 = np.sin(np.radians(30.0))
+    k0 = np.cos(np.radians(30.0)) / np.sqrt(1 - ee**2*sinPhi1**2)
+    # Half width of the grid (m): the grid spans 360 degrees of lon
+    xMax = aa*k0*np.pi
+    # Cell size (m)
+    cellSize = 2*xMax/nLon
+    # x and y (m) of the cell centers
+    xx = (np.arange(nLon)+0.5)*cellSize - xMax
+    yy = nLat/2*cellSize - (np.arange(nLat)+0.5)*cellSize
+    # Longitude
+    lon = np.degrees(xx/(aa*k0))
+    # Latitude, from the authalic latitude (series expansion of the inverse)
+    qp = (1-ee**2)*(1/(1-ee**2) - 1/(2*ee)*np.log((1-ee)/(1+ee)))
+    beta = np.arcsin(np.clip(2*yy*k0/(aa*qp), -1, 1))
+    lat = beta + (ee**2/3 + 31*ee**4/180 + 517*ee**6/5040)*np.sin(2*beta) + (23*ee**4/360 + 251*ee**6/3780)*np.sin(4*beta) + (761*ee**6/45360)*np.sin(6*beta)
+    lat = np.degrees(lat)
+    return lon, lat
+
+# Function to get the 1-d lon and lat (float32, as in the SMAP files) of the grid with nLat rows and nLon columns. The grid is fixed, so it is computed (see easeGridLonLat) rather than read from a SMAP file. If cacheDir is given, it is saved there the first time and loaded from there afterwards.
+def getGridLonLat(nLat=406, nLon=964, cacheDir=None):
+    if cacheDir is not None:
+        cacheFn = Path(cacheDir) / ('easeGrid_' + str(nLat) + 'x' + str(nLon) + '.npz')
+        cached = readCache(cacheFn)
+        if cached is not None:
+            return cached['lonData'], cached['latData']
+    lon, lat = easeGridLonLat(nLat, nLon)
+    lonData = lon.astype(np.float32)
+    latData = lat.astype(np.float32)
+    if cacheDir is not None:
+        writeCache(cacheFn, lonData=lonData, latData=latData)
+    return lonData, latData
@@ -0,0 +1,214 @@
+'''
+This file contains functions that keep track of which SMAP days have been committed to the time series of a domain, so that an interrupted run can be resumed and a finished run can be extended with new days.
+The manifest (manifest_<outputFormat><tag>.json in the output directory, where tag identifies the tile when the domain is split, see getTileTag in smapUtils) records the domain, the last committed date, the days skipped because they had no SMAP file (in update mode), the number of committed batches, for the text files the size of every pixel's file (in a separate .npy file that the manifest points to) and, if they are kept, the file of the running statistics of the time series (see smapAggregate.py). A batch is committed by writing a new sizes file and then atomically replacing the manifest, so the manifest always describes complete batches. Anything written after the last commit (including the update of the statistics, which are updated in place) is rolled back at the start of the next run.
+'''
+import datetime as dt
+import hashlib
+import json
+import os
+import h5py as h5
+import numpy as np
+from pathlib import Path
+from smapFiles import atomicWrite
+from smapUtils import getFn
+from smapAggregate import createAggregates, openAggregates, closeAggregates, rollbackAggregates, mergeTileAggregates
+
+# Function to return the name of the manifest of an output directory
+def getManifestFn(outDir, outputFormat, tag=''):
+    return str(Path(outDir) / ('manifest_' + outputFormat + tag + '.json'))
+
+# Function to compute a key that identifies the domain (pixel IDs and their lon/lat)
+def getDomainKey(domainPixelsArr):
+    key = hashlib.sha1()
+    for name in ['pixelId', 'longitude', 'latitude']:
+        key.update(np.ascontiguousarray(domainPixelsArr[name]).tobytes())
+    return key.hexdigest()
+
+# Function to read the manifest of an output directory (None if there is none). The pixel file sizes are loaded into manifest['sizes'].
+def readManifest(outDir, outputFormat, tag=''):
+    manifestFn = getManifestFn(outDir, outputFormat, tag)
+    if not Path(manifestFn).is_file():
+        return None
+    with open(manifestFn) as fid:
+        manifest = json.load(fid)
+    manifest.setdefault('tag', tag)
+    manifest.setdefault('aggregatesFile', None)
+    manifest.setdefault('skippedDates', [])
+    if manifest['sizesFile'] is not None:
+        manifest['sizes'] = np.load(Path(outDir) / manifest['sizesFile'])
+    else:
+        manifest['sizes'] = None
+    return manifest
+
+# Function to create the manifest of a run that starts from scratch: nothing is committed (unless the sizes of the text files are given). Write it with writeManifest before any output is written, so that the writes of an interrupted first batch are rolled back too.
+def newManifest(outDir, outputFormat, domainPixelsArr, storeFn=None, tag='', sizes=None):
+    manifest = {'outputFormat': outputFormat, 'tag': tag, 'domainKey': getDomainKey(domainPixelsArr), 'nPixels': len(domainPixelsArr), 'firstDate': None, 'lastDate': None, 'nBatches': 0, 'sizesFile': None, 'storeFn': storeFn, 'nTime': 0, 'aggregatesFile': None, 'skippedDates': []}
+    if sizes is not None:
+        manifest['sizes'] = sizes
+    elif outputFormat == 'text':
+        manifest['sizes'] = np.zeros([len(domainPixelsArr)], dtype=np.int64)
+    else:
+        manifest['sizes'] = None
+    return manifest
+
+# Function to check that an output directory without a manifest holds no time series of the domain. Nothing of them is known to be committed, so they would be rolled back (deleted).
+def checkNoOutput(outDir, outputFormat, domainPixelsArr, storeFn=None):
+    if outputFormat == 'text':
+        exists = [pixelId for pixelId in domainPixelsArr['pixelId'] if (Path(outDir) / (pixelId + '.txt')).is_file()]
+        if exists:
+            raise ValueError("The output directory holds time series (e.g. " + exists[0] + ".txt) but no manifest of the days they hold. Move them to another directory or remove them to start over.")
+    elif outputFormat == 'hdf5':
+        if storeFn is not None and Path(storeFn).is_file():
+            raise ValueError("The store " + str(storeFn) + " exists but the output directory has no manifest of the days it holds. Move it or remove it to start over.")
+
+# Function to return the size of a file (0 if it does not exist)
+def getFileSize(fn):
+    try:
+        return os.path.getsize(fn)
+    except FileNotFoundError:
+        return 0
+
+# Function to check that the manifest is for the same domain
+def checkManifest(manifest, domainPixelsArr):
+    if manifest['domainKey'] != getDomainKey(domainPixelsArr):
+        raise ValueError("The output directory holds time series of a different domain. Use another output directory, or remove its manifest and time series to start over.")
+
+# Function to roll the output back to the last commit of the manifest (undo the writes of an interrupted batch)
+def rollbackToManifest(manifest, outDir, domainPixelsArr):
+    if manifest['outputFormat'] == 'text':
+        for pixelId, size in zip(domainPixelsArr['pixelId'], manifest['sizes']):
+            fn = Path(outDir) / (pixelId + '.txt')
+            actualSize = getFileSize(fn)
+            if actualSize > size:
+                # Files created by an uncommitted batch are removed, so that they get their header when written again
+                if size == 0:
+                    fn.unlink()
+                else:
+                    os.truncate(fn, size)
+    elif manifest['outputFormat'] == 'hdf5':
+        if Path(manifest['storeFn']).is_file():
+            ff = h5.File(manifest['storeFn'], 'a')
+            if ff['day'].shape[0] > manifest['nTime']:
+                ff['day'].resize((manifest['nTime'],))
+                for name in ff['timeseries']:
+                    ff['timeseries'][name].resize(manifest['nTime'], axis=1)
+            ff.close()
+    # Statistics updated with an uncommitted batch
+    aggregatesFn = getManifestAggregatesFn(manifest, outDir)
+    if aggregatesFn is not None:
+        aggregates = openAggregates(aggregatesFn)
+        rollbackAggregates(aggregates, manifest['nBatches'])
+        closeAggregates(aggregates)
+
+# Function to return the first date that still needs to be processed, given the requested start date
+def getResumeDate(manifest, dateStart):
+    if manifest['lastDate'] is None:
+        return dateStart
+    firstDate = dt.date.fromisoformat(manifest['firstDate'])
+    lastDate = dt.date.fromisoformat(manifest['lastDate'])
+    if dateStart < firstDate:
+        raise ValueError("The time series start on " + manifest['firstDate'] + "; they can only be extended with later days.")
+    return max(dateStart, lastDate + dt.timedelta(days=1))
+
+# Function to return the file of the statistics kept with the manifest (None if none are kept)
+def getManifestAggregatesFn(manifest, outDir):
+    if manifest['aggregatesFile'] is None:
+        return None
+    return Path(outDir) / manifest['aggregatesFile']
+
+# Function to start keeping statistics (see smapAggregate.py) of the given fields and groups with the manifest. Returns the file of the statistics.
+def addManifestAggregates(manifest, outDir, fields, groups=None):
+    manifest['aggregatesFile'] = 'manifest_' + manifest['outputFormat'] + manifest['tag'] + '_aggregates.h5'
+    createAggregates(Path(outDir) / manifest['aggregatesFile'], manifest['nPixels'], fields, groups, nBatches=manifest['nBatches'])
+    writeManifest(manifest, outDir)
+    return Path(outDir) / manifest['aggregatesFile']
+
+# Function to commit a batch: record its last date and the new state of the output (bytes appended to each text file, or the new length of the store's time axis). The statistics, if they are kept, must have been updated with the batch (see updateAggregates in smapAggregate.py). The days from the end of the previous batch (or from dateStart, for the first batch of the output) that are not among the dates of the batch (days without a SMAP file) are recorded as skipped.
+def commitBatch(manifest, outDir, dates, nBytes=None, nTime=None, dateStart=None):
+    if manifest['lastDate'] is not None:
+        fromDate = dt.date.fromisoformat(manifest['lastDate']) + dt.timedelta(days=1)
+    else:
+        fromDate = dates[0] if dateStart is None else min(dateStart, dates[0])
+    manifest['skippedDates'] = manifest['skippedDates'] + [(fromDate + dt.timedelta(days=dd)).isoformat() for dd in range((dates[-1]-fromDate).days) if fromDate + dt.timedelta(days=dd) not in dates]
+    manifest['nBatches'] += 1
+    if manifest['firstDate'] is None:
+        manifest['firstDate'] = fromDate.isoformat()
+    manifest['lastDate'] = dates[-1].isoformat()
+    if nTime is not None:
+        manifest['nTime'] = nTime
+    writeManifest(manifest, outDir, sizes=(manifest['sizes'] + nBytes if nBytes is not None else None))
+
+# Function to write the manifest (atomically replacing the previous one), with new pixel file sizes if given
+def writeManifest(manifest, outDir, sizes=None):
+    oldSizesFile = manifest['sizesFile']
+    if sizes is not None:
+        manifest['sizes'] = sizes
+        # A new sizes file per commit, so that the manifest always points to complete sizes
+        manifest['sizesFile'] = 'manifest_' + manifest['outputFormat'] + manifest['tag'] + '_sizes_' + str(manifest['nBatches']) + '.npy'
+        atomicWrite(Path(outDir) / manifest['sizesFile'], lambda fid: np.save(fid, manifest['sizes']))
+    # Replace the manifest
+    record = {key: value for key, value in manifest.items() if key != 'sizes'}
+    atomicWrite(getManifestFn(outDir, manifest['outputFormat'], manifest['tag']), lambda fid: fid.write(json.dumps(record, indent=1).encode()))
+    # The previous sizes file is no longer needed
+    if oldSizesFile is not None and oldSizesFile != manifest['sizesFile']:
+        (Path(outDir) / oldSizesFile).unlink()
+
+# Function to check that the tiles of a domain have all been committed up to the same days. tilePixels are the indices of the pixels of each tile (see getTilePixels in smapUtils). Returns the manifests of the tiles.
+def checkTileManifests(outDir, outputFormat, domainPixelsArr, tilePixels, tileTags):
+    manifests = []
+    for tag, pixelIdcs in zip(tileTags, tilePixels):
+        manifest = readManifest(outDir, outputFormat, tag)
+        if manifest is None:
+            raise ValueError("Tile " + tag + " has not been processed (no manifest).")
+        checkManifest(manifest, domainPixelsArr[pixelIdcs])
+        manifests.append(manifest)
+    # Every tile must hold the same days
+    for manifest, tag in zip(manifests, tileTags):
+        if (manifest['firstDate'], manifest['lastDate']) != (manifests[0]['firstDate'], manifests[0]['lastDate']):
+            raise ValueError("Tile " + tag + " holds " + str(manifest['firstDate']) + " to " + str(manifest['lastDate']) + ", but tile " + tileTags[0] + " holds " + str(manifests[0]['firstDate']) + " to " + str(manifests[0]['lastDate']) + ".")
+        if manifest['skippedDates'] != manifests[0]['skippedDates']:
+            raise ValueError("Tile " + tag + " skipped other days (without a SMAP file) than tile " + tileTags[0] + ".")
+    return manifests
+
+# Function to write the manifest of the whole domain from the manifests of its tiles (see checkTileManifests), so the merged output can be extended by an untiled run. If the tiles kept statistics, they are merged too.
+def writeMergedManifest(outDir, outputFormat, domainPixelsArr, tilePixels, manifests, storeFn=None):
+    # Manifest of the whole domain (replacing the one of a previous merge)
+    sizes = None
+    if outputFormat == 'text':
+        # The files were written in outDir by the tiles: gather their committed sizes
+        sizes = np.zeros([len(domainPixelsArr)], dtype=np.int64)
+        for manifest, pixelIdcs in zip(manifests, tilePixels):
+            sizes[pixelIdcs] = manifest['sizes']
+    merged = newManifest(outDir, outputFormat, domainPixelsArr, storeFn=storeFn, sizes=sizes)
+    previous = readManifest(outDir, outputFormat)
+    if previous is not None:
+        merged['nBatches'] = previous['nBatches']
+        merged['sizesFile'] = previous['sizesFile']
+    merged['nBatches'] += 1
+    merged['firstDate'] = manifests[0]['firstDate']
+    merged['lastDate'] = manifests[0]['lastDate']
+    merged['nTime'] = manifests[0]['nTime']
+    merged['skippedDates'] = manifests[0]['skippedDates']
+    # Statistics of the domain, from those of the tiles
+    tileAggregatesFns = [getManifestAggregatesFn(manifest, outDir) for manifest in manifests]
+    if any(fn is not None for fn in tileAggregatesFns):
+        if any(fn is None for fn in tileAggregatesFns):
+            raise ValueError("Only some of the tiles kept statistics.")
+        merged['aggregatesFile'] = 'manifest_' + outputFormat + '_aggregates.h5'
+        mergeTileAggregates(Path(outDir) / merged['aggregatesFile'], tileAggregatesFns, tilePixels, len(domainPixelsArr), merged['nBatches'])
+    writeManifest(merged, outDir, sizes=sizes)
+    return merged
+
+# Function to return the dates for which a SMAP file exists (from the date directories of the product, e.g. SPL3SMP/2015.04.01)
+def getAvailableDates(smapDir, type):
+    # Directory of the product, from the file name of any date
+    productDir = Path(getFn(date=dt.date(2015,1,1), smapDir=smapDir, type=type)).parent.parent
+    dates = []
+    for dateDir in productDir.iterdir():
+        try:
+            thisDate = dt.datetime.strptime(dateDir.name, '%Y.%m.%d').date()
+        except ValueError:
+            continue
+        if Path(getFn(date=thisDate, smapDir=smapDir, type=type)).is_file():
+            dates.append(thisDate)
+    return sorted(dates)
@@ -0,0 +1,88 @@
+'''
+This file contains functions that are used to measure the time and bytes of each stage of the time series creation, to report them per batch (with an ETA) and to log them as JSON lines
+Metrics are a dict of stage name -> [seconds, bytes]. Functions add to them as they go; per-batch values are the difference between two snapshots.
+'''
+import cProfile
+import datetime as dt
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+# Function to create empty metrics
+def newMetrics():
+    return {}
+
+# Function to add seconds and bytes to a stage
+def addMetrics(metrics, stage, seconds=0.0, nBytes=0):
+    if metrics is None:
+        return
+    values = metrics.setdefault(stage, [0.0, 0])
+    values[0] += seconds
+    values[1] += int(nBytes)
+
+# Context manager that adds the time spent in its block to a stage (does nothing if metrics is None)
+@contextmanager
+def stageTimer(metrics, stage, nBytes=0):
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        addMetrics(metrics, stage, time.perf_counter()-tic, nBytes)
+
+# Function to return the number of bytes of the arrays in columns (a dict of arrays) or of a string
+def sizeOf(data):
+    if isinstance(data, str):
+        return len(data)
+    if isinstance(data, dict):
+        return sum(column.nbytes for column in data.values())
+    return data.nbytes
+
+# Function to take a snapshot of metrics (to compute the metrics of a batch with diffMetrics)
+def snapshotMetrics(metrics):
+    return {stage: list(values) for stage, values in metrics.items()}
+
+# Function to return the metrics accumulated since a snapshot
+def diffMetrics(metrics, snapshot):
+    diff = {}
+    for stage, (seconds, nBytes) in metrics.items():
+        oldSeconds, oldBytes = snapshot.get(stage, [0.0, 0])
+        diff[stage] = [seconds-oldSeconds, nBytes-oldBytes]
+    return diff
+
+# Function to format a number of seconds as h:mm:ss
+def formatDuration(seconds):
+    return str(dt.timedelta(seconds=round(seconds)))
+
+# Function to summarize the metrics of a batch in one line, with the throughput and the ETA of the run
+def batchSummary(batchMetrics, bb, nBatches, nDays, nPixels, batchSeconds, elapsed, daysDone, daysTotal):
+    stages = ', '.join(stage + ' {0:.2f} s'.format(seconds) + (' {0:.1f} MB'.format(nBytes/1024**2) if nBytes else '') for stage, (seconds, nBytes) in batchMetrics.items())
+    eta = elapsed/daysDone*(daysTotal-daysDone)
+    return 'Batch ' + str(bb+1) + ' of ' + str(nBatches) + ': ' + str(nDays) + ' days in {0:.2f} s ({1}), {2:.0f} pixel-days/s, elapsed {3}, ETA {4}'.format(batchSeconds, stages, nDays*nPixels/batchSeconds, formatDuration(elapsed), formatDuration(eta))
+
+# Function to append a record (dict) to a JSON-lines metrics log (does nothing if metricsFn is None)
+def logMetrics(metricsFn, record):
+    if metricsFn is None:
+        return
+    with open(metricsFn, 'a') as fid:
+        fid.write(json.dumps(record) + '\n')
+
+# Function to start profiling with cProfile (returns None if profiling is not requested)
+def startProfile(profile):
+    if not profile:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+# Function to stop profiling, save the statistics (open with pstats or snakeviz) and print the functions with the most cumulative time
+def stopProfile(profiler, profileFn, nLines=25):
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.dump_stats(profileFn)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(nLines)
+    print(out.getvalue())
+    print('Profile saved to ' + profileFn)
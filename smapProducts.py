@@ -0,0 +1,50 @@
+'''
+This file contains the registry of the SMAP products that can be read: where their files are, the size of their grid and the names of their groups and fields
+Product information found here:
+https://nsidc.org/data/spl3smp (36 km) and https://nsidc.org/data/spl3smp_e (9 km enhanced)
+Both grids are the global cylindrical EASE-Grid 2.0 (see smapGrid.py).
+'''
+
+# Function to get the products, by the type used throughout the scripts (e.g. getFn(date, smapDir, type='SMP'))
+def getProductTable():
+    productTable = {
+        'SMP': {
+            # Directory of the product in smapDir, and prefix of its file names
+            'dir': 'SPL3SMP',
+            'prefix': 'SMAP_L3_SM_P_',
+            # Size of the grid
+            'nLat': 406,
+            'nLon': 964,
+            # Group of each pass (am, pm) and the suffix of the field names in that group
+            'passes': [('Soil_Moisture_Retrieval_Data_AM', ''), ('Soil_Moisture_Retrieval_Data_PM', '_pm')],
+            # Names of the datasets of the fields (see getFieldsAndDataTypes) that are not named after the field
+            'fieldNames': {},
+        },
+        'SMP_E': {
+            'dir': 'SPL3SMP_E',
+            'prefix': 'SMAP_L3_SM_P_E_',
+            'nLat': 1624,
+            'nLon': 3856,
+            'passes': [('Soil_Moisture_Retrieval_Data_AM', ''), ('Soil_Moisture_Retrieval_Data_PM', '_pm')],
+            'fieldNames': {},
+        },
+    }
+    return productTable
+
+# Function to get the description of one product (see getProductTable)
+def getProduct(type):
+    productTable = getProductTable()
+    if type not in productTable:
+        raise NameError("Requested SMAP type not supported.")
+    return productTable[type]
+
+# Function to get the type of the product whose grid has nLat rows and nLon columns (e.g. the shape of the 2-d fields of its files)
+def getGridProductType(nLat, nLon):
+    for type, product in getProductTable().items():
+        if (product['nLat'], product['nLon']) == (nLat, nLon):
+            return type
+    raise ValueError("No SMAP product has a grid of " + str(nLat) + "x" + str(nLon) + " cells.")
+
+# Function to get the name of the dataset of a field in the group of a pass (suffix is the suffix of the pass in 'passes')
+def getDatasetName(product, field, suffix=''):
+    return product['fieldNames'].get(field, field) + suffix
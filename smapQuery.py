@@ -0,0 +1,164 @@
+'''
+This file contains functions that are used to query the time series written by createTimeseries.py: the series of some pixels (by pixelId or lon/lat) or of every pixel in a lon/lat box, for a range of dates, as numpy arrays.
+Queries of the HDF5 store (see smapStore.py) are lazy: the store is kept open and only its index (the pixels and the day of each time step) is read when it is opened. A query then reads only the chunks of the store that hold the requested pixels and dates.
+The text files (<pixelId>.txt) can be loaded too, with one vectorized parse per file instead of a loop over its lines.
+Both select the retrievals of a range of dates by the UTC day of their tb_time_utc: the text files do not record the day of the SMAP file a retrieval comes from, and around midnight UTC that day can differ from the UTC day of the retrieval.
+'''
+import datetime as dt
+import h5py as h5
+import numpy as np
+from smapUtils import getFieldsAndDataTypes, getColumnDataTypes, getColumnFillValues, utcToMs
+
+# Function to open a store for queries. Returns the query handle: a dict with the open store and its index. Close it with closeTsQuery.
+def openTsQuery(storeFn):
+    ff = h5.File(storeFn, 'r')
+    pixels = ff['pixels'][()]
+    query = {'file': ff, 'storeFn': storeFn}
+    # Index of the pixels: pixelId -> position on the pixel axis
+    query['pixelIds'] = pixels['pixelId'].astype(str)
+    query['pixelIdx'] = {pixelId: pp for pp, pixelId in enumerate(query['pixelIds'])}
+    query['longitude'] = pixels['longitude']
+    query['latitude'] = pixels['latitude']
+    # The pixels sorted by lon, to find the pixels near a lon/lat or in a box with binary searches
+    query['lonOrder'] = np.argsort(pixels['longitude'], kind='stable')
+    query['sortedLon'] = pixels['longitude'][query['lonOrder']]
+    # Day of each time step (sorted, since the store only grows forward in time)
+    query['days'] = ff['day'][()].astype('datetime64[D]')
+    return query
+
+# Function to close a query handle
+def closeTsQuery(query):
+    query['file'].close()
+
+# Function to return the positions (on the pixel axis of the store) of the given pixelIds. Unknown pixelIds raise a KeyError.
+def getPixelIdcs(query, pixelIds):
+    return np.array([query['pixelIdx'][pixelId] for pixelId in pixelIds], dtype=np.int64)
+
+# Function to return the positions of the pixels closest to each lon/lat (-1 where there is no pixel within maxDist degrees, e.g. half an NLDAS cell)
+def getNearestPixelIdcs(query, lons, lats, maxDist=0.0625):
+    idcs = np.full([len(lons)], -1, dtype=np.int64)
+    for qq, (qLon, qLat) in enumerate(zip(lons, lats)):
+        # Candidates: the pixels within maxDist of the lon
+        first = np.searchsorted(query['sortedLon'], qLon-maxDist, side='left')
+        last = np.searchsorted(query['sortedLon'], qLon+maxDist, side='right')
+        candidates = query['lonOrder'][first:last]
+        if len(candidates) == 0:
+            continue
+        dist2 = (query['longitude'][candidates]-qLon)**2 + (query['latitude'][candidates]-qLat)**2
+        nearest = np.argmin(dist2)
+        if dist2[nearest] <= maxDist**2:
+            idcs[qq] = candidates[nearest]
+    return idcs
+
+# Function to return the positions (sorted) of the pixels in a lon/lat box (bounds included)
+def getBoxPixelIdcs(query, minLon, maxLon, minLat, maxLat):
+    first = np.searchsorted(query['sortedLon'], minLon, side='left')
+    last = np.searchsorted(query['sortedLon'], maxLon, side='right')
+    candidates = query['lonOrder'][first:last]
+    lats = query['latitude'][candidates]
+    return np.sort(candidates[(lats >= minLat) & (lats <= maxLat)])
+
+# Function to return the slice of the time axis of the days from dateStart up to (but not including) dateEnd (None for the first/last day of the store)
+def getTimeSlice(query, dateStart=None, dateEnd=None):
+    tStart = 0 if dateStart is None else np.searchsorted(query['days'], np.datetime64(dateStart, 'D'), side='left')
+    tEnd = len(query['days']) if dateEnd is None else np.searchsorted(query['days'], np.datetime64(dateEnd, 'D'), side='left')
+    return slice(int(tStart), int(tEnd))
+
+# Function to read the series of the pixels at the given positions, with the retrievals whose tb_time_utc is from dateStart up to (but not including) dateEnd (None for no bound)
+def queryPixels(query, pixelIdcs, dateStart=None, dateEnd=None, fields=None):
+    '''
+    Returns a dict of [nPixels,nTime] arrays (one per field, in the order of pixelIdcs, with the data types and fill values of getColumnDataTypes and getColumnFillValues in smapUtils) and the day of each time step (the day of its SMAP file).
+    The time steps are those of the SMAP files of the dates, and of the files of the day before or after them that hold retrievals of the dates (their UTC day can differ from the day of the file around midnight UTC). Retrievals of other dates are filled with the fill values (as if there was no retrieval), so the query selects the same retrievals as readTextTs.
+    Each chunk of the store that holds requested pixels is read once, with all the requested pixels in it: reading the pixels one by one would decompress a chunk once per pixel.
+    '''
+    grp = query['file']['timeseries']
+    if fields is None:
+        fields = list(grp)
+    # The SMAP files of the dates and of the days next to them
+    oneDay = dt.timedelta(days=1)
+    timeSlice = getTimeSlice(query, (None if dateStart is None else dateStart-oneDay), (None if dateEnd is None else dateEnd+oneDay))
+    pixelIdcs = np.asarray(pixelIdcs, dtype=np.int64)
+    readFields = fields if (dateStart is None and dateEnd is None) or 'tb_time_utc' in fields else list(fields) + ['tb_time_utc']
+    tsData = {name: readPixels(grp[name], pixelIdcs, timeSlice) for name in readFields}
+    days = query['days'][timeSlice]
+    if dateStart is None and dateEnd is None:
+        return tsData, days
+    # Retrievals of the dates (by UTC day)
+    tbTime = tsData['tb_time_utc']
+    hasRetrieval = tbTime != getColumnFillValues()['tb_time_utc']
+    utcDays = np.where(hasRetrieval, tbTime, 0).astype('datetime64[ms]').astype('datetime64[D]')
+    inRange = hasRetrieval.copy()
+    stepInRange = np.ones(days.shape, dtype=bool)
+    if dateStart is not None:
+        inRange &= utcDays >= np.datetime64(dateStart, 'D')
+        stepInRange &= days >= np.datetime64(dateStart, 'D')
+    if dateEnd is not None:
+        inRange &= utcDays < np.datetime64(dateEnd, 'D')
+        stepInRange &= days < np.datetime64(dateEnd, 'D')
+    # Keep the time steps of the dates, and those of the next days that hold retrievals of the dates
+    keepSteps = stepInRange | inRange.any(axis=0)
+    # Fill the retrievals of other dates (the localTime of a time step is kept, as it is where there is no retrieval)
+    fillValues = getColumnFillValues()
+    drop = hasRetrieval & ~inRange
+    for name in fields:
+        if name != 'localTime':
+            tsData[name][drop] = fillValues[name]
+    return {name: tsData[name][:,keepSteps] for name in fields}, days[keepSteps]
+
+# Function to read the series of a dataset of the store ([nPixels,nTime]) at the given positions of the pixel axis, for a slice of the time axis
+def readPixels(ds, pixelIdcs, timeSlice):
+    nTime = len(range(ds.shape[1])[timeSlice])
+    # The requested pixels, grouped by chunk of the pixel axis
+    chunkPixels = ds.chunks[0]
+    order = np.argsort(pixelIdcs, kind='stable')
+    sortedIdcs = pixelIdcs[order]
+    chunkStarts = np.flatnonzero(np.diff(sortedIdcs // chunkPixels, prepend=-1) != 0)
+    chunkEnds = np.r_[chunkStarts[1:], len(sortedIdcs)]
+    values = np.empty([len(pixelIdcs), nTime], dtype=ds.dtype)
+    for first, last in zip(chunkStarts, chunkEnds):
+        # Read the rows of the chunk from the first to the last requested pixel in it
+        lo = sortedIdcs[first]
+        hi = sortedIdcs[last-1] + 1
+        block = ds[lo:hi, timeSlice]
+        values[order[first:last]] = block[sortedIdcs[first:last]-lo]
+    return values
+
+# Function to read the series of the given pixelIds (see queryPixels)
+def queryPixelIds(query, pixelIds, dateStart=None, dateEnd=None, fields=None):
+    return queryPixels(query, getPixelIdcs(query, pixelIds), dateStart, dateEnd, fields)
+
+# Function to read the series of every pixel in a lon/lat box (see queryPixels). Also returns the pixelIds of the pixels.
+def queryBox(query, minLon, maxLon, minLat, maxLat, dateStart=None, dateEnd=None, fields=None):
+    pixelIdcs = getBoxPixelIdcs(query, minLon, maxLon, minLat, maxLat)
+    tsData, days = queryPixels(query, pixelIdcs, dateStart, dateEnd, fields)
+    return query['pixelIds'][pixelIdcs], tsData, days
+
+# Function to load a text file written by createTimeseries.py (<pixelId>.txt, see formatAsString) into 1-d columns with the data types of getColumnDataTypes in smapUtils. Only the retrievals whose tb_time_utc is from dateStart up to (but not including) dateEnd are kept (None for no bound), as in queryPixels.
+def readTextTs(fName, dateStart=None, dateEnd=None):
+    fields, dataTypes = getFieldsAndDataTypes()[:2]
+    with open(fName) as fid:
+        # Header: lon and lat of the pixel, then the names of the columns
+        lon = np.float32(fid.readline().split()[1])
+        lat = np.float32(fid.readline().split()[1])
+        fid.readline()
+        # Body: parsed in one go
+        body = np.loadtxt(fid, dtype=dataTypes[2:], ndmin=1)
+    columnTypes = dict(getColumnDataTypes())
+    tsData = {}
+    tsData['longitude'] = np.full([len(body)], lon, dtype=columnTypes['longitude'])
+    tsData['latitude'] = np.full([len(body)], lat, dtype=columnTypes['latitude'])
+    for name in fields[2:]:
+        if name == 'tb_time_utc':
+            tsData[name] = utcToMs(body[name])
+        elif name == 'localTime':
+            tsData[name] = (body[name] == 'PM').astype(columnTypes[name])
+        else:
+            tsData[name] = body[name].astype(columnTypes[name])
+    # Keep the retrievals of the date range
+    keep = np.ones([len(body)], dtype=bool)
+    days = tsData['tb_time_utc'].astype('datetime64[ms]').astype('datetime64[D]')
+    if dateStart is not None:
+        keep &= days >= np.datetime64(dateStart, 'D')
+    if dateEnd is not None:
+        keep &= days < np.datetime64(dateEnd, 'D')
+    return {name: column[keep] for name, column in tsData.items()}
@@ -0,0 +1,119 @@
+'''
+This file contains functions that are used to write and read the SMAP time series store: a single chunked, compressed HDF5 file that holds the time series of every pixel of the domain.
+Each field is a 2-d dataset laid out as (pixel, time), chunked so that reading the series of one pixel touches few chunks. The time axis grows by one block per batch (am and pm of each day).
+Every append rewrites the chunks it only partly fills, so long chunks along time make appends slow: with 128x128 chunks (64 days) appending 8-day batches for 20000 pixels was 3 times faster than with 64x512 chunks, and reading the series of a pixel was no slower. See smapQuery.py to read the series of some pixels.
+The fields are stored with the compact data types of the columns representation (see getColumnDataTypes in smapUtils).
+'''
+import h5py as h5
+import numpy as np
+from pathlib import Path
+from smapUtils import getColumnDataTypes, columnsToRecords, formatBatchAsStrings
+
+# Function to create an empty store for the domain pixels (does nothing if the store already exists)
+def createTsStore(storeFn, domainPixelsArr, columnTypes=None, chunkPixels=128, chunkTime=128):
+    if Path(storeFn).is_file():
+        return
+    if columnTypes is None:
+        columnTypes = getColumnDataTypes()
+    nPix = len(domainPixelsArr)
+    ff = h5.File(storeFn, 'w')
+    # The domain pixels, in the order of the pixel axis
+    pixels = np.empty([nPix], dtype=[('longitude',np.float32), ('latitude',np.float32), ('pixelId','S9')])
+    pixels['longitude'] = domainPixelsArr['longitude']
+    pixels['latitude'] = domainPixelsArr['latitude']
+    pixels['pixelId'] = np.char.encode(domainPixelsArr['pixelId'], 'ascii')
+    ff.create_dataset('pixels', data=pixels)
+    # The date of each time step (days since 1970-01-01)
+    ff.create_dataset('day', shape=(0,), maxshape=(None,), dtype=np.int32, chunks=(chunkTime,))
+    ff['day'].attrs['units'] = 'days since 1970-01-01'
+    # One (pixel, time) dataset per field
+    grp = ff.create_group('timeseries')
+    for name, dtype in columnTypes:
+        grp.create_dataset(name, shape=(nPix,0), maxshape=(nPix,None), dtype=dtype, chunks=(min(nPix,chunkPixels), chunkTime), compression='gzip', compression_opts=4, shuffle=True)
+    if 'tb_time_utc' in grp:
+        grp['tb_time_utc'].attrs['units'] = 'milliseconds since 1970-01-01T00:00:00Z'
+    if 'localTime' in grp:
+        grp['localTime'].attrs['units'] = '0: AM, 1: PM'
+    ff.close()
+
+# Function to append a batch of data to the store. batchTs are [nPixels,2*nDays] columns (pixels in the order of the store), dates are the days of the batch. Returns the new length of the time axis.
+def appendToTsStore(storeFn, batchTs, dates):
+    ff = h5.File(storeFn, 'a')
+    grp = ff['timeseries']
+    # Current and new length of the time axis
+    nOld = ff['day'].shape[0]
+    nNew = nOld + next(iter(batchTs.values())).shape[1]
+    # Day of each time step (am and pm of each date)
+    days = np.repeat(np.array(dates, dtype='datetime64[D]').astype(np.int32), 2)
+    ff['day'].resize((nNew,))
+    ff['day'][nOld:nNew] = days
+    # Write each field as one block
+    for name, column in batchTs.items():
+        grp[name].resize(nNew, axis=1)
+        grp[name][:,nOld:nNew] = column
+    ff.close()
+    # Return the new length of the time axis
+    return nNew
+
+# Function to read the data of a range of pixels from the store, as [nPixels,nTime] columns
+def readTsStore(storeFn, pixelSlice=slice(None)):
+    ff = h5.File(storeFn, 'r')
+    grp = ff['timeseries']
+    tsData = {name: grp[name][pixelSlice,:] for name in grp}
+    ff.close()
+    return tsData
+
+# Function to export the store to the legacy format of one text file per pixel (<pixelId>.txt). Existing files are overwritten. Retrievals rejected by qualityFilter (see flaggedMask in smapFlags.py) are left out.
+def exportTsStoreToText(storeFn, outDir, chunkPixels=128, qualityFilter=None):
+    ff = h5.File(storeFn, 'r')
+    pixelIds = ff['pixels']['pixelId'].astype(str)
+    ff.close()
+    # Read blocks of pixels at once to read each chunk of the store only once
+    for pp in range(0, len(pixelIds), chunkPixels):
+        tsData = columnsToRecords(readTsStore(storeFn, slice(pp, pp+chunkPixels)))
+        # Format the block, without data that have no lon value (indicates no retrieval) or that are rejected by the quality filter
+        strings = formatBatchAsStrings(tsData, qualityFilter)
+        for ii in range(tsData.shape[0]):
+            # Pixels without any retrieval don't get a file (same as the text writer)
+            if strings[ii] is None:
+                continue
+            bodyStr, headerStr = strings[ii]
+            with open(outDir + '/' + pixelIds[pp+ii] + '.txt', 'w') as fid:
+                fid.write(headerStr + bodyStr)
+
+# Function to return the name of the store of a tile (the tag is added before the extension)
+def getTileStoreFn(storeFn, tag):
+    storeFn = Path(storeFn)
+    return str(storeFn.with_name(storeFn.stem + tag + storeFn.suffix))
+
+# Function to merge the stores of the tiles of a domain into one store for the whole domain (replacing it if it exists). tilePixels are the (sorted) indices of the pixels of each tile in domainPixelsArr, as returned by getTilePixels. The tiles must hold the same days.
+def mergeTsStores(storeFn, domainPixelsArr, tileStoreFns, tilePixels, chunkPixels=128, chunkTime=128):
+    # The days of every tile
+    days = None
+    for tileFn in tileStoreFns:
+        ff = h5.File(tileFn, 'r')
+        tileDays = ff['day'][()]
+        columnTypes = [(name, ff['timeseries'][name].dtype) for name in ff['timeseries']]
+        ff.close()
+        if days is None:
+            days = tileDays
+        elif not np.array_equal(days, tileDays):
+            raise ValueError("Store " + tileFn + " does not hold the same days as " + tileStoreFns[0] + ".")
+    # Create the merged store with the days of the tiles
+    tmpFn = storeFn + '.tmp'
+    Path(tmpFn).unlink(missing_ok=True)
+    createTsStore(tmpFn, domainPixelsArr, columnTypes, chunkPixels, chunkTime)
+    out = h5.File(tmpFn, 'a')
+    out['day'].resize((len(days),))
+    out['day'][:] = days
+    for name, dtype in columnTypes:
+        out['timeseries'][name].resize(len(days), axis=1)
+    # Copy the tiles, one block of time steps at a time
+    for tileFn, pixelIdcs in zip(tileStoreFns, tilePixels):
+        ff = h5.File(tileFn, 'r')
+        for name, dtype in columnTypes:
+            for tt in range(0, len(days), chunkTime):
+                out['timeseries'][name][pixelIdcs, tt:tt+chunkTime] = ff['timeseries'][name][:, tt:tt+chunkTime]
+        ff.close()
+    out.close()
+    Path(tmpFn).replace(storeFn)
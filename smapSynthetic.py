@@ -0,0 +1,81 @@
+'''
+This file contains functions that write synthetic SMAP L3 soil moisture files (SPL3SMP or SPL3SMP_E, see smapProducts.py), laid out like the real files so that the processing scripts can be run and timed without the real archive.
+The files have the AM and PM groups (PM field names end in '_pm'), the EASE-Grid 2.0 of the product (406x964 or 1624x3856), -9999 fill values where there is no retrieval (ocean and gaps between swaths) and random flag bits. The values are random but reproducible (the seed depends on the date).
+'''
+import datetime as dt
+import h5py as h5
+import numpy as np
+from pathlib import Path
+from smapUtils import getFn, getFieldsAndDataTypes
+from smapGrid import easeGridLonLat
+from smapProducts import getProduct, getDatasetName
+
+# Function to create a land mask for the grid: ellipses roughly where the continents are (the same for every day)
+def syntheticLandMask(lon, lat):
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    land = np.zeros(lon2d.shape, dtype=bool)
+    # Center lon, center lat, lon radius and lat radius (degrees) of each continent
+    for cLon, cLat, rLon, rLat in [(-100, 45, 35, 22), (-60, -15, 17, 25), (20, 5, 22, 30), (75, 50, 70, 20), (135, -25, 17, 11)]:
+        land |= ((lon2d-cLon)/rLon)**2 + ((lat2d-cLat)/rLat)**2 <= 1
+    return land
+
+# Function to create the swath coverage of one pass: gaps between the swaths that are widest at the equator and close towards the poles, shifting from day to day
+def syntheticSwaths(lon, lat, date, pm):
+    shift = (date.toordinal()*37 + (19 if pm else 0)) % len(lon)
+    cols = (np.arange(len(lon)) + shift) % 90
+    gapWidth = 30*np.cos(np.radians(lat))**6
+    return cols[None,:] < 90 - gapWidth[:,None]
+
+# Function to write one synthetic SMAP file (fn) of the product (type) for the given date
+def writeSyntheticSmapFile(fn, date, type='SMP', seed=0):
+    rng = np.random.default_rng([seed, date.toordinal()])
+    product = getProduct(type)
+    nLat = product['nLat']
+    nLon = product['nLon']
+    lon, lat = easeGridLonLat(nLat, nLon)
+    land = syntheticLandMask(lon, lat)
+    fields, dataTypes = getFieldsAndDataTypes()[:2]
+    Path(fn).parent.mkdir(parents=True, exist_ok=True)
+    ff = h5.File(fn, 'w')
+    for pm, (grpName, suffix), hour in zip([False, True], product['passes'], [6, 18]):
+        grp = ff.create_group(grpName)
+        # Cells with a retrieval
+        valid = land & syntheticSwaths(lon, lat, date, pm)
+        # Values of each field
+        values = {}
+        values['longitude'] = np.tile(lon.astype(np.float32), (nLat, 1))
+        values['latitude'] = np.tile(lat.astype(np.float32)[:,None], (1, nLon))
+        values['soil_moisture'] = rng.uniform(0.02, 0.5, (nLat, nLon)).astype(np.float32)
+        values['soil_moisture_error'] = rng.uniform(0.01, 0.06, (nLat, nLon)).astype(np.float32)
+        values['tb_v_corrected'] = rng.uniform(180, 300, (nLat, nLon)).astype(np.float32)
+        values['vegetation_water_content'] = rng.gamma(1.5, 2, (nLat, nLon)).astype(np.float32)
+        # Flags: a few bits raised at random (more often for the surface conditions that are common)
+        for field, nBits, prob in [('retrieval_qual_flag', 4, 0.15), ('surface_flag', 12, 0.1), ('tb_qual_flag_v', 13, 0.05)]:
+            bits = rng.random((nLat, nLon, nBits)) < prob
+            values[field] = (bits * (1 << np.arange(nBits))).sum(axis=-1).astype(np.uint16)
+        # Time of the overpass: later towards the west (local solar time is about constant)
+        seconds = (hour*3600 - values['longitude']*240 + rng.uniform(-600, 600, (nLat, nLon))) % 86400
+        times = np.datetime64(date) + (seconds*1000).astype('timedelta64[ms]')
+        values['tb_time_utc'] = np.char.add(np.datetime_as_string(times, unit='ms'), 'Z').astype('S24')
+        # Write the fields, with fill values where there is no retrieval
+        for name, dtype in dataTypes[:-1]:
+            data = values[name]
+            if name == 'tb_time_utc':
+                data = np.where(valid, data, b'N/A')
+            elif name in ['retrieval_qual_flag', 'surface_flag', 'tb_qual_flag_v']:
+                data = np.where(valid, data, 65534).astype(np.uint16)
+            else:
+                data = np.where(valid, data, -9999.0).astype(np.float32)
+            grp.create_dataset(getDatasetName(product, name, suffix), data=data, chunks=(nLat//2, nLon//4), compression='gzip', compression_opts=4)
+    ff.close()
+
+# Function to write synthetic SMAP files for the days from dateStart up to (but not including) dateEnd, where getFn expects them. Existing files are kept.
+def writeSyntheticArchive(smapDir, dateStart, dateEnd, type='SMP', seed=0):
+    fns = []
+    for dd in range((dateEnd-dateStart).days):
+        thisDate = dateStart + dt.timedelta(days=dd)
+        fn = getFn(date=thisDate, smapDir=smapDir, type=type)
+        if not Path(fn).is_file():
+            writeSyntheticSmapFile(fn, thisDate, type=type, seed=seed)
+        fns.append(fn)
+    return fns
@@ -4,8 +4,22 @@ P. Shellito 6/14/18
 '''
 import datetime as dt
 import h5py as h5
+import hashlib
+import multiprocessing as mp
 import numpy as np
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
+from smapFiles import readCache, writeCache
+from smapFlags import flaggedMask
+from smapGrid import getGridLonLat
+from smapProducts import getProduct, getGridProductType, getDatasetName
+from smapMetrics import addMetrics, stageTimer, sizeOf
 
 # Function to enlarge lon and lat data so as to properly center the pixels created by pcolormesh
 def enlargeLonLat(lons, lats, dlon, dlat):
@@ -22,13 +36,11 @@ def enlargeLonLat(lons, lats, dlon, dlat):
     lats = np.r_[ lats, [lats[-1,:]+dlat] ]
     return lons, lats
 
-# Function to return the file name of the SMAP file from a specific date
+# Function to return the file name of the SMAP file from a specific date (type is a product of getProductTable in smapProducts.py)
 def getFn(date, smapDir, type):
-    if type == 'SMP':
-        typeDir = '/SPL3SMP/'
-        filePrefix = 'SMAP_L3_SM_P_'
-    else:
-        raise NameError("Requested SMAP type not supported.")
+    product = getProduct(type)
+    typeDir = '/' + product['dir'] + '/'
+    filePrefix = product['prefix']
     if not isinstance(date, dt.date):
         raise TypeError("Requested day must be of type datetime.date")
     if not isinstance(smapDir, str):
@@ -36,15 +48,16 @@ def getFn(date, smapDir, type):
     fn = smapDir + typeDir + date.strftime('%Y.%m.%d/') + filePrefix + date.strftime('%Y%m%d.h5')
     return fn
 
-# Function the read the lon/lat fields from the SMAP file (NOT enhanced
-def getSmapLonLat(fn):
+# Function the read the lon/lat fields from the SMAP file
+def getSmapLonLat(fn, type='SMP'):
+    product = getProduct(type)
     # Open file
     ff = h5.File(fn, 'r')
     # Size of the SMAP data
-    nLat = 406
-    nLon = 964
+    nLat = product['nLat']
+    nLon = product['nLon']
     # Name of AM group
-    amGrp = 'Soil_Moisture_Retrieval_Data_AM'
+    amGrp = product['passes'][0][0]
     # Names of fields to save
     lonLatFields = ['longitude',               'latitude']
     # Data types of those fields
@@ -54,28 +67,49 @@ def getSmapLonLat(fn):
     # Loop through required fields
     for rr in range(len(lonLatFields)):
         # Fill this field in the structured array with the SMAP data
-        struc[lonLatFields[rr]][:,:] = ff[amGrp][lonLatFields[rr]][()]
+        struc[lonLatFields[rr]][:,:] = ff[amGrp][getDatasetName(product, lonLatFields[rr])][()]
     # Close file
     ff.close()
     return struc
 
-# Function to read the soil moisture and other fields from the SMAP file (NOT enhanced)
-def getSmapSm(fn, am=False, pm=False):
+# Function to find the rows and columns of the grid to read, from either slices or a bounding box (minLon,maxLon,minLat,maxLat). Defaults to the full grid.
+def getWindow(rows=None, cols=None, bbox=None, lonData=None, latData=None, type='SMP'):
+    # Find the window of the grid that covers the bounding box
+    if bbox is not None:
+        if lonData is None or latData is None:
+            product = getProduct(type)
+            lonData, latData = getGridLonLat(product['nLat'], product['nLon'])
+        rows, cols = getTrimSlices(lonData,latData,*bbox)
+    # Default to the full grid
+    if rows is None:
+        rows = slice(None)
+    if cols is None:
+        cols = slice(None)
+    return rows, cols
+
+# Function to read the soil moisture and other fields from the SMAP file
+def getSmapSm(fn, am=False, pm=False, rows=None, cols=None, bbox=None, lonData=None, latData=None, fields=None, type='SMP'):
+    '''
+    Read the requested SMAP fields into a structured array of shape [nLat,nLon,2] (am and pm).
+    Only a window of the global grid is read from each HDF5 dataset if either rows/cols (slices of the grid, as returned by getTrimSlices) or bbox (minLon,maxLon,minLat,maxLat) are given. When bbox is given, lonData and latData (as returned by getGridLonLat) are used to find the window; they are computed for the grid of the product if not provided.
+    fields is a list of the field names to read (default: all fields in getFieldsAndDataTypes). The localTime field is always included.
+    '''
+    # Window of the grid to read
+    product = getProduct(type)
+    rows, cols = getWindow(rows, cols, bbox, lonData, latData, type)
     # Open file
     ff = h5.File(fn, 'r')
 #    # Print the dataset names
 #    for nn in ff.keys():
 #        print(nn)
 #        print(list(ff[nn].keys()))
-    # Size of the SMAP data
-    nLat = 406
-    nLon = 964
-    # Name of AM group
-    amGrp = 'Soil_Moisture_Retrieval_Data_AM'
-    # Name of PM group
-    pmGrp = 'Soil_Moisture_Retrieval_Data_PM'
+    # Size of the window to read
+    nLat = len(range(product['nLat'])[rows])
+    nLon = len(range(product['nLon'])[cols])
+    # Names of the AM and PM groups, and the suffixes of their fields
+    (amGrp, amSuffix), (pmGrp, pmSuffix) = product['passes']
     # Names of required fields to save
-    reqFields, dataTypes = getFieldsAndDataTypes()[0:2]
+    reqFields, dataTypes = selectFieldsAndDataTypes(fields)
     # Initialize a structure array to hold the data (am and pm)
     struc = np.empty([nLat,nLon,2],dtype=dataTypes)
     # Loop through required fields (but not the 'localTime' field)
@@ -83,22 +117,156 @@ def getSmapSm(fn, am=False, pm=False):
         # Fill this field in the structured array with the SMAP data
         # If am data are requested
         if am:
-            struc[reqFields[rr]][:,:,0] = ff[amGrp][reqFields[rr]][()]
+            struc[reqFields[rr]][:,:,0] = ff[amGrp][getDatasetName(product, reqFields[rr], amSuffix)][rows,cols]
         else:
             struc[reqFields[rr]][:,:,0] = np.nan
-        # Record the localTime as AM
-        struc['localTime'][:,:,0] = 'AM'
         # If pm data are requested
         if pm:
-            struc[reqFields[rr]][:,:,1] = ff[pmGrp][reqFields[rr]+'_pm'][()]
+            struc[reqFields[rr]][:,:,1] = ff[pmGrp][getDatasetName(product, reqFields[rr], pmSuffix)][rows,cols]
         else:
             struc[reqFields[rr]][:,:,1] = np.nan
-        # Record the localTime as PM
-        struc['localTime'][:,:,1] = 'PM'
+    # Record the localTime as AM and PM
+    struc['localTime'][:,:,0] = 'AM'
+    struc['localTime'][:,:,1] = 'PM'
     # Close file
     ff.close()
     return struc
 
+# Function to read the soil moisture and other fields from the SMAP file into columns (see getColumnDataTypes)
+def getSmapSmColumns(fn, am=False, pm=False, rows=None, cols=None, bbox=None, lonData=None, latData=None, fields=None, qualityFilter=None, type='SMP'):
+    '''
+    Same as getSmapSm, but the data are returned as a dict of one contiguous [nLat,nLon,2] array per field, with the compact data types of getColumnDataTypes. Data of a pass that is not requested (am or pm) are filled with the fill values of getColumnFillValues (i.e. as if there was no retrieval).
+    qualityFilter is a dict of flag field -> list of flag names (see flaggedMask in smapFlags.py). The flag fields are read first, and retrievals with any of those flags raised are filled with the fill values instead of their data, so they are dropped like retrievals without data. The other fields of a pass without any remaining retrieval are not read at all.
+    '''
+    # Window of the grid to read
+    product = getProduct(type)
+    rows, cols = getWindow(rows, cols, bbox, lonData, latData, type)
+    # Open file
+    ff = h5.File(fn, 'r')
+    # Size of the window to read
+    nLat = len(range(product['nLat'])[rows])
+    nLon = len(range(product['nLon'])[cols])
+    # Names of the AM and PM groups, and the suffixes of their fields
+    (amGrp, amSuffix), (pmGrp, pmSuffix) = product['passes']
+    # Names of required fields to save
+    reqFields = selectFieldsAndDataTypes(fields)[0]
+    columnTypes = dict(getColumnDataTypes())
+    fillValues = getColumnFillValues()
+    # Initialize the columns (am and pm)
+    columns = allocateColumns([nLat,nLon,2], [(name, columnTypes[name]) for name in reqFields])
+    for pp, (requested, grp, suffix) in enumerate([(am, amGrp, amSuffix), (pm, pmGrp, pmSuffix)]):
+        # Retrievals rejected by the quality filter (the flag fields that are read are kept for below)
+        flagData = {}
+        rejected = None
+        if requested and qualityFilter:
+            flagData = {field: ff[grp][getDatasetName(product, field, suffix)][rows,cols] for field in qualityFilter}
+            rejected = flaggedMask(flagData, qualityFilter)
+            if rejected.all():
+                requested = False
+        # Loop through required fields (but not the 'localTime' field)
+        for name in reqFields[:-1]:
+            if not requested:
+                columns[name][:,:,pp] = fillValues[name]
+                continue
+            if name in flagData:
+                columns[name][:,:,pp] = flagData[name]
+            elif name == 'tb_time_utc':
+                columns[name][:,:,pp] = utcToMs(ff[grp][getDatasetName(product, name, suffix)][rows,cols])
+            else:
+                columns[name][:,:,pp] = ff[grp][getDatasetName(product, name, suffix)][rows,cols]
+            # Drop the rejected retrievals
+            if rejected is not None:
+                columns[name][:,:,pp][rejected] = fillValues[name]
+    # Record the localTime as AM (0) and PM (1)
+    columns['localTime'][:,:,0] = 0
+    columns['localTime'][:,:,1] = 1
+    # Close file
+    ff.close()
+    return columns
+
+# Function to read the soil moisture and other fields of the given pixels from the SMAP file into [nPixels,2] columns (see getSmapSmColumns), streaming the file in blocks of rows that are aligned with its HDF5 chunks
+def getSmapSmPixels(fn, latIdcs, lonIdcs, am=False, pm=False, rows=None, cols=None, fields=None, qualityFilter=None, type='SMP', blockRows=256):
+    '''
+    latIdcs and lonIdcs are the row and column of each pixel in the window given by rows and cols (as returned by selectSmapPixels for the trimmed lon/lat). The result is the same as gatherColumns(getSmapSmColumns(...), latIdcs, lonIdcs), but the window is never held in memory: it is read one block of rows at a time, and only the pixels are kept. This is what makes the 9 km enhanced product (16 times the cells of the 36 km product) fit in the memory budget of a batch.
+    The blocks are aligned with the chunks of the datasets (blockRows rows if they are not chunked), so that each chunk is decompressed only once, and blocks without any pixel are not read at all. Each block is read with read_direct into a buffer that is reused from block to block.
+    '''
+    # Window of the grid to read
+    product = getProduct(type)
+    rows, cols = getWindow(rows, cols, type=type)
+    windowRows = range(product['nLat'])[rows]
+    windowCols = range(product['nLon'])[cols]
+    # Row of the grid of each pixel, and the pixels sorted by row (to find the pixels of each block)
+    pixelRows = windowRows.start + np.asarray(latIdcs)
+    lonIdcs = np.asarray(lonIdcs)
+    order = np.argsort(pixelRows, kind='stable')
+    sortedRows = pixelRows[order]
+    # Names of required fields to save
+    reqFields = selectFieldsAndDataTypes(fields)[0]
+    columnTypes = dict(getColumnDataTypes())
+    fillValues = getColumnFillValues()
+    # Initialize the columns (am and pm)
+    columns = allocateColumns([len(pixelRows),2], [(name, columnTypes[name]) for name in reqFields])
+    # Open file
+    ff = h5.File(fn, 'r')
+    for pp, (requested, (grp, suffix)) in enumerate(zip([am, pm], product['passes'])):
+        # Fill the pass if it is not requested
+        if not requested:
+            for name in reqFields[:-1]:
+                columns[name][:,pp] = fillValues[name]
+            continue
+        # Datasets of the required fields (but not the 'localTime' field) and of the flag fields of the quality filter
+        datasets = {name: ff[grp][getDatasetName(product, name, suffix)] for name in reqFields[:-1]}
+        if qualityFilter:
+            datasets.update({field: ff[grp][getDatasetName(product, field, suffix)] for field in qualityFilter})
+        if not datasets:
+            continue
+        # Rows per block: the rows of a chunk (of the first field read)
+        chunks = next(iter(datasets.values())).chunks
+        nBlockRows = chunks[0] if chunks is not None else blockRows
+        # Buffer of a block of each field
+        buffers = {name: np.empty([nBlockRows, len(windowCols)], dtype=ds.dtype) for name, ds in datasets.items()}
+        # Function to read a block of rows of a field and return the values of the pixels in it
+        def readBlock(name, rowStart, rowEnd, blockRowIdcs, blockColIdcs):
+            datasets[name].read_direct(buffers[name], np.s_[rowStart:rowEnd, windowCols.start:windowCols.stop], np.s_[0:rowEnd-rowStart, :])
+            return buffers[name][blockRowIdcs, blockColIdcs]
+        # Loop through the blocks that start at a chunk boundary
+        for chunkStart in range(windowRows.start - windowRows.start % nBlockRows, windowRows.stop, nBlockRows):
+            rowStart = max(chunkStart, windowRows.start)
+            rowEnd = min(chunkStart + nBlockRows, windowRows.stop)
+            # Pixels in this block
+            first, last = np.searchsorted(sortedRows, [rowStart, rowEnd])
+            if first == last:
+                continue
+            blockPixels = order[first:last]
+            blockRowIdcs = pixelRows[blockPixels] - rowStart
+            blockColIdcs = lonIdcs[blockPixels]
+            # Retrievals rejected by the quality filter (the flag fields that are read are kept for below)
+            flagData = {}
+            rejected = None
+            if qualityFilter:
+                flagData = {field: readBlock(field, rowStart, rowEnd, blockRowIdcs, blockColIdcs) for field in qualityFilter}
+                rejected = flaggedMask(flagData, qualityFilter)
+            for name in reqFields[:-1]:
+                if rejected is not None and rejected.all():
+                    columns[name][blockPixels,pp] = fillValues[name]
+                    continue
+                if name in flagData:
+                    values = flagData[name]
+                else:
+                    values = readBlock(name, rowStart, rowEnd, blockRowIdcs, blockColIdcs)
+                if name == 'tb_time_utc':
+                    values = utcToMs(values)
+                columns[name][blockPixels,pp] = values
+                # Drop the rejected retrievals
+                if rejected is not None:
+                    columns[name][blockPixels[rejected],pp] = fillValues[name]
+    # Record the localTime as AM (0) and PM (1)
+    columns['localTime'][:,0] = 0
+    columns['localTime'][:,1] = 1
+    # Close file
+    ff.close()
+    return columns
+
 # Function to get the field names and data types of the SMAP data to be read. NOTE: this includes a field for localTime, which will be an AM/PM indicator
 def getFieldsAndDataTypes():
     # Field Names
@@ -109,48 +277,138 @@ def getFieldsAndDataTypes():
     printFormat = '{0:24s} {1:9f} {2:9f} {3:5n} {4:5n} {5:6.2f} {6:5n} {7:9f} {8:2s}\n'
     return reqFields, dataTypes, printFormat
 
+# Function to get the printf-style equivalent of the printFormat of getFieldsAndDataTypes, which formats many rows in a single operation (it must produce the same text)
+def getBulkPrintFormat():
+    return '%-24s %9f %9f %5d %5d %6.2f %5d %9f %-2s\n'
+
+# Function to select a subset of the fields and data types. The localTime field is always kept (and kept last)
+def selectFieldsAndDataTypes(fields=None):
+    reqFields, dataTypes = getFieldsAndDataTypes()[0:2]
+    if fields is None:
+        return reqFields, dataTypes
+    # Check that the requested fields exist
+    unknown = set(fields) - set(reqFields)
+    if unknown:
+        raise NameError("Requested SMAP fields not supported: " + ', '.join(sorted(unknown)))
+    # Keep the order of getFieldsAndDataTypes
+    keep = [ff in fields or ff == 'localTime' for ff in reqFields]
+    reqFields = [ff for ff, kk in zip(reqFields, keep) if kk]
+    dataTypes = [dd for dd, kk in zip(dataTypes, keep) if kk]
+    return reqFields, dataTypes
+
+# Function to get the field names and data types of the columns (struct-of-arrays) representation of the SMAP data: the same fields as getFieldsAndDataTypes, but tb_time_utc is an int64 number of milliseconds since 1970-01-01 (see utcToMs) and localTime is 0 (AM) or 1 (PM)
+def getColumnDataTypes():
+    columnTypes = []
+    for name, dtype in getFieldsAndDataTypes()[1]:
+        if name == 'tb_time_utc':
+            dtype = np.int64
+        elif name == 'localTime':
+            dtype = np.uint8
+        columnTypes.append((name, dtype))
+    return columnTypes
+
+# Function to get the values that the columns are filled with where there is no retrieval
+def getColumnFillValues():
+    fillValues = {}
+    for name, dtype in getColumnDataTypes():
+        if name == 'tb_time_utc':
+            fillValues[name] = np.iinfo(np.int64).min
+        elif np.dtype(dtype).kind == 'f':
+            fillValues[name] = -9999.0
+        else:
+            fillValues[name] = np.iinfo(dtype).max - 1
+    return fillValues
+
+# Function to convert the tb_time_utc strings (e.g. '2015-04-01T12:34:56.789Z') to milliseconds since 1970-01-01. Strings that are not times become the fill value of getColumnFillValues.
+def utcToMs(utcStrs):
+    # Convert in the same way as when assigning to the U24 field of getFieldsAndDataTypes
+    strs = np.empty(np.shape(utcStrs), dtype='U24')
+    strs[...] = utcStrs
+    ms = np.full(strs.shape, np.iinfo(np.int64).min, dtype=np.int64)
+    # Only full length times are converted (without the 'Z': numpy does not parse time zones)
+    valid = (np.char.str_len(strs) == 24) & (np.char.endswith(strs, 'Z'))
+    ms[valid] = strs[valid].astype('U23').astype('datetime64[ms]').astype(np.int64)
+    return ms
+
+# Function to convert milliseconds since 1970-01-01 back to the tb_time_utc strings. The fill value becomes 'NaT'.
+def msToUtc(ms):
+    ms = np.asarray(ms)
+    utcStrs = np.full(ms.shape, 'NaT', dtype='U24')
+    valid = ms != np.iinfo(np.int64).min
+    utcStrs[valid] = np.char.add(np.datetime_as_string(ms[valid].astype('datetime64[ms]'), unit='ms'), 'Z')
+    return utcStrs
+
+# Function to allocate empty columns of the given shape for the given (field name, data type) pairs. If spillDir is given, the columns are memory-mapped to (anonymous, deleted on close) files in that directory instead of held in memory.
+def allocateColumns(shape, columnTypes, spillDir=None):
+    if spillDir is None:
+        return {name: np.empty(shape, dtype=dtype) for name, dtype in columnTypes}
+    Path(spillDir).mkdir(parents=True, exist_ok=True)
+    columns = {}
+    for name, dtype in columnTypes:
+        with tempfile.TemporaryFile(dir=spillDir) as fid:
+            # The mapping stays valid after the file is closed
+            columns[name] = np.memmap(fid, dtype=dtype, mode='w+', shape=tuple(shape))
+    return columns
+
+# Function to estimate the memory (bytes) that one day of a batch costs: the [nLat,nLon,2] cube (once for the batch being written, once for the batch being assembled and once per prefetched batch), the [nPixels,2] gathered columns and, for the text writer, the records and formatted text of the pixels. If the pixels are gathered while reading (see getSmapSmPixels), the batches hold [nPixels,2] columns instead of the cube. aggregateBytes is what the update of the running statistics costs per day (see estimateAggregateDayBytes in smapAggregate.py).
+def estimateDayBytes(nLat, nLon, nPixels, columnTypes, prefetch=1, text=True, gathered=False, aggregateBytes=0):
+    cellBytes = sum(np.dtype(dtype).itemsize for name, dtype in columnTypes)
+    cubeBytes = (nPixels if gathered else nLat*nLon)*2*cellBytes
+    pixelBytes = nPixels*2*cellBytes
+    if text:
+        # Records of getFieldsAndDataTypes plus about 100 characters of text per retrieval
+        pixelBytes += nPixels*2*(np.dtype(getFieldsAndDataTypes()[1]).itemsize + 100)
+    return cubeBytes*(prefetch+2) + pixelBytes + aggregateBytes
+
+# Function to choose the number of days per batch that fits in memBudget (bytes). If batchDays is given it is kept. Also returns whether the batch cube must be spilled to disk (when even the requested/minimum batch does not fit).
+def chooseBatchDays(memBudget, dayBytes, batchDays=None):
+    if batchDays is None:
+        batchDays = max(1, int(memBudget // dayBytes))
+    spill = batchDays*dayBytes > memBudget
+    return batchDays, spill
+
+# Function to pull the data at the given (row, column) of the grid out of each column ([nLat,nLon,nTime] to [nPixels,nTime])
+def gatherColumns(columns, latIdcs, lonIdcs):
+    return {name: column[latIdcs,lonIdcs] for name, column in columns.items()}
+
+# Function to convert columns to the structured array of getFieldsAndDataTypes (only the fields present in columns). This is only done at output time.
+def columnsToRecords(columns):
+    reqFields, dataTypes = selectFieldsAndDataTypes([name for name in columns if name != 'localTime'])
+    shape = next(iter(columns.values())).shape
+    records = np.empty(shape, dtype=dataTypes)
+    for name in reqFields:
+        if name == 'tb_time_utc':
+            records[name] = msToUtc(columns[name])
+        elif name == 'localTime':
+            records[name] = np.where(columns[name] == 0, 'AM', 'PM')
+        else:
+            records[name] = columns[name]
+    return records
+
+# Function to find the row and column slices of the grid that cover the requested range: the columns with minLon <= lon <= maxLon and the rows with minLat <= lat <= maxLat. lonData must increase and latData decrease (as the grid of getGridLonLat does), so the bounds are found with binary searches.
+def getTrimSlices(lonData,latData,minLon,maxLon,minLat,maxLat):
+    # First column at or east of minLon and first column east of maxLon
+    minLonIdx = np.searchsorted(lonData, minLon, side='left')
+    maxLonIdx = np.searchsorted(lonData, maxLon, side='right')
+    # First row at or south of maxLat and first row south of minLat (lat decreases, so search its negative)
+    negLat = -np.asarray(latData)
+    maxLatIdx = np.searchsorted(negLat, -maxLat, side='left')
+    minLatIdx = np.searchsorted(negLat, -minLat, side='right')
+    # Return the slices of rows (lat) and columns (lon)
+    return slice(int(maxLatIdx),int(minLatIdx)), slice(int(minLonIdx),int(maxLonIdx))
+
 # Function to trim 2d data to requested range
 def trimData(data,lonData,latData,minLon,maxLon,minLat,maxLat):
-    # Difference between longitudes and requested min and max lons
-    lonDiffMin = lonData-minLon
-    lonDiffMax = maxLon-lonData
-    # Difference between latitudes and requested min and max lats
-    latDiffMin = latData-minLat
-    latDiffMax = maxLat-latData
-    # Closest postive differences
-    minLonVal = min(lonDiffMin[lonDiffMin>=0])
-    maxLonVal = min(lonDiffMax[lonDiffMax>=0])
-    minLatVal = min(latDiffMin[latDiffMin>=0])
-    maxLatVal = min(latDiffMax[latDiffMax>=0])
-    # Indices of those values
-    minLonIdx = lonDiffMin.tolist().index(minLonVal)
-    maxLonIdx = lonDiffMax.tolist().index(maxLonVal)+1
-    minLatIdx = latDiffMin.tolist().index(minLatVal)+1
-    maxLatIdx = latDiffMax.tolist().index(maxLatVal)
+    rows, cols = getTrimSlices(lonData,latData,minLon,maxLon,minLat,maxLat)
     # Return trimmed data
-    return data[maxLatIdx:minLatIdx,minLonIdx:maxLonIdx]
+    return data[rows,cols]
 
 # Function to trim 3d data to requested range
 def trimData3d(data,lonData,latData,minLon,maxLon,minLat,maxLat):
     # This function is the same as above but "data" is a matrix that has a third dimension
-    # Difference between longitudes and requested min and max lons
-    lonDiffMin = lonData-minLon
-    lonDiffMax = maxLon-lonData
-    # Difference between latitudes and requested min and max lats
-    latDiffMin = latData-minLat
-    latDiffMax = maxLat-latData
-    # Closest postive differences
-    minLonVal = min(lonDiffMin[lonDiffMin>=0])
-    maxLonVal = min(lonDiffMax[lonDiffMax>=0])
-    minLatVal = min(latDiffMin[latDiffMin>=0])
-    maxLatVal = min(latDiffMax[latDiffMax>=0])
-    # Indices of those values
-    minLonIdx = lonDiffMin.tolist().index(minLonVal)
-    maxLonIdx = lonDiffMax.tolist().index(maxLonVal)+1
-    minLatIdx = latDiffMin.tolist().index(minLatVal)+1
-    maxLatIdx = latDiffMax.tolist().index(maxLatVal)
+    rows, cols = getTrimSlices(lonData,latData,minLon,maxLon,minLat,maxLat)
     # Return trimmed data
-    return data[maxLatIdx:minLatIdx,minLonIdx:maxLonIdx,:]
+    return data[rows,cols,:]
 
 # A function that will replace specific values in a data field with nan
 def nanfill(data,nanval,fieldName):
@@ -169,6 +427,47 @@ def selectSmapPixel(lonData, latData, qLon, qLat):
     latIdx = nearestIdx(latData,qLat)
     return lonIdx, latIdx
 
+# Function that returns the index of the item closest to each of the pivots (the same as nearestIdx for each pivot, with ties going to the first item), using a binary search over the sorted items
+def nearestIdcs(items, pivots):
+    pivots = np.asarray(pivots)
+    # Sort the items. The sort is stable, so equal items keep their order.
+    order = np.argsort(items, kind='stable')
+    sortedItems = items[order]
+    # Position of each pivot among the sorted items
+    pos = np.searchsorted(sortedItems, pivots)
+    # Candidates: the closest item below the pivot (the first of equal items) and the closest item above it
+    below = np.clip(pos-1, 0, len(items)-1)
+    below = np.searchsorted(sortedItems, sortedItems[below])
+    above = np.clip(pos, 0, len(items)-1)
+    belowIdx = order[below]
+    aboveIdx = order[above]
+    # Distances to the candidates
+    belowDiff = np.abs(items[belowIdx]-pivots)
+    aboveDiff = np.abs(items[aboveIdx]-pivots)
+    # Closest candidate. Ties go to the first item.
+    idcs = np.where(aboveDiff < belowDiff, aboveIdx, belowIdx)
+    ties = aboveDiff == belowDiff
+    idcs[ties] = np.minimum(belowIdx[ties], aboveIdx[ties])
+    return idcs
+
+# Function to select the smap pixel closest to each of the NLDAS pixels. Returns the index into lonData and latData of each pixel. If cacheDir is given, the result is cached there, keyed by the domain and the grid.
+def selectSmapPixels(lonData, latData, domainPixelsArr, cacheDir=None):
+    if cacheDir is not None:
+        # Key of the cache: the domain pixels and the lon/lat values of the grid
+        key = hashlib.sha1()
+        for arr in [domainPixelsArr['longitude'], domainPixelsArr['latitude'], np.asarray(lonData), np.asarray(latData)]:
+            key.update(str(arr.dtype).encode())
+            key.update(np.ascontiguousarray(arr).tobytes())
+        cacheFn = Path(cacheDir) / ('pixelMap_' + key.hexdigest() + '.npz')
+        cached = readCache(cacheFn)
+        if cached is not None:
+            return cached['lonIdcs'], cached['latIdcs']
+    lonIdcs = nearestIdcs(lonData, domainPixelsArr['longitude'])
+    latIdcs = nearestIdcs(latData, domainPixelsArr['latitude'])
+    if cacheDir is not None:
+        writeCache(cacheFn, lonIdcs=lonIdcs, latIdcs=latIdcs)
+    return lonIdcs, latIdcs
+
 # Function to remove retrievals without lon data (indicates no overpass)
 def removeNoData(smapTs):
     noDataIdcs = smapTs['longitude']==-9999.0
@@ -180,16 +479,45 @@ def formatAsString(smapTs):
     # Get fields and data types
     fields, dataTypes, printFormat = getFieldsAndDataTypes()
     # Create header string
-    headerStr = ''
     headerStr = fields[0] + ' {}\n'.format(smapTs[fields[0]][0]) + \
                 fields[1] + ' {}\n'.format(smapTs[fields[1]][0]) + \
                 ' '.join(fields[2:]) + '\n'
-    # Create string with all the data in it
-    bodyStr = ''
-    for ll in range(len(smapTs)):
-        bodyStr = bodyStr + printFormat.format(smapTs[fields[2]][ll], smapTs[fields[3]][ll], smapTs[fields[4]][ll], smapTs[fields[5]][ll], smapTs[fields[6]][ll], smapTs[fields[7]][ll], smapTs[fields[8]][ll], smapTs[fields[9]][ll], smapTs[fields[10]][ll])
+    # Create string with all the data in it: one printf-style format of every row at once (the values are interleaved row by row)
+    values = chain.from_iterable(zip(*[smapTs[ff].tolist() for ff in fields[2:]]))
+    bodyStr = (getBulkPrintFormat()*len(smapTs)) % tuple(values)
     return bodyStr, headerStr
 
+# Function to format a whole batch of data ([nPixels,nTime] structured array). Data without a lon value are removed (as removeNoData does), as well as data rejected by qualityFilter (see flaggedMask in smapFlags.py) if given. Returns a list of (bodyStr, headerStr) per pixel, or None for pixels without any retrieval.
+def formatBatchAsStrings(batchTs, qualityFilter=None):
+    # Get fields and data types
+    fields = getFieldsAndDataTypes()[0]
+    bulkFormat = getBulkPrintFormat()
+    nFormat = len(fields) - 2
+    columnHeader = ' '.join(fields[2:]) + '\n'
+    # Retrievals to keep, in pixel order, and how many each pixel has
+    keep = batchTs['longitude']!=-9999.0
+    if qualityFilter:
+        keep &= ~flaggedMask(batchTs, qualityFilter)
+    counts = keep.sum(axis=1)
+    starts = np.r_[0, np.cumsum(counts)]
+    kept = batchTs[keep]
+    # Convert all values to python objects once, interleaved row by row
+    values = tuple(chain.from_iterable(zip(*[kept[ff].tolist() for ff in fields[2:]])))
+    lons = kept[fields[0]].tolist()
+    lats = kept[fields[1]].tolist()
+    strings = []
+    for pp in range(len(counts)):
+        if counts[pp] == 0:
+            strings.append(None)
+            continue
+        # One format per pixel for all its rows
+        bodyStr = (bulkFormat*int(counts[pp])) % values[starts[pp]*nFormat:starts[pp+1]*nFormat]
+        headerStr = fields[0] + ' {}\n'.format(np.float32(lons[starts[pp]])) + \
+                    fields[1] + ' {}\n'.format(np.float32(lats[starts[pp]])) + \
+                    columnHeader
+        strings.append((bodyStr, headerStr))
+    return strings
+
 # Function to write to file
 def writeToFile(fName, bodyStr, headerStr=''):
     # See if file exists
@@ -204,6 +532,27 @@ def writeToFile(fName, bodyStr, headerStr=''):
         printStr = bodyStr
     fid.write(printStr)
     fid.close()
+    # Return the number of characters written (the files are ascii, so this is also the number of bytes)
+    return len(printStr)
+
+# Function to write a batch of data to the text files of the pixels (<pixelId>.txt in outDir). batchTs is a [nPixels,nTime] structured array in the order of pixelIds. Returns the number of bytes appended to each file. If metrics is given (see smapMetrics.py), the time and bytes of the 'format' and 'write' stages are added to it.
+def writeBatchToText(outDir, pixelIds, batchTs, qualityFilter=None, metrics=None):
+    # Format every pixel's data, without data that have no lon value (indicates no retrieval) or that are rejected by the quality filter
+    with stageTimer(metrics, 'format'):
+        strings = formatBatchAsStrings(batchTs, qualityFilter)
+    nBytes = np.zeros([len(pixelIds)], dtype=np.int64)
+    with stageTimer(metrics, 'write'):
+        for ff in range(len(pixelIds)):
+            # Nothing to write if there was no retrieval in this batch
+            if strings[ff] is None:
+                continue
+            # Name of file to write to
+            fName = outDir + '/' + pixelIds[ff] + '.txt'
+            bodyStr, headerStr = strings[ff]
+            # Write the data to the file. Open with append 'a' mode. Close when done.(include header if first time writing--if file did not exist)
+            nBytes[ff] = writeToFile(fName,bodyStr,headerStr)
+    addMetrics(metrics, 'write', nBytes=nBytes.sum())
+    return nBytes
 
 # A function that will trim vectors down to only include values within a specific range
 def trim1d(data,minn,maxx):
@@ -213,17 +562,15 @@ def trim1d(data,minn,maxx):
 
 # A function that will do the processing necessary to fill in lon and lat values and enlarge them
 def processLatLon(mapObj,cLon,cLat,minLon,maxLon,minLat,maxLat):
-    # cLon and cLat are the "complete' lon and lat fields (not trimmed). The ranges provided by min/max lon/lat indicate what we intend to plot)
-    # 1-dimensional lon and lat fields
-    lon1d=np.nanmean(cLon ,axis=0)
-    lat1d=np.nanmean(cLat ,axis=1)
-    #print(lon1d)
-    #print(lat1d)
-    # Trim the lon and lat down
-    trimmedLon = trim1d(lon1d,minLon,maxLon)
-    trimmedLat = trim1d(lat1d,minLat,maxLat)
-    #print(trimmedLon)
-    #print(trimmedLat)
+    # cLon and cLat are the "complete' lon and lat fields (not trimmed): either the 1-d lon and lat of the grid (see getGridLonLat) or the 2-d fields of a SMAP file. The ranges provided by min/max lon/lat indicate what we intend to plot)
+    # 1-dimensional lon and lat fields: those of the grid of the product of the 2-d fields (the fields of a file are filled where there is no retrieval, so they can lack whole rows and columns). Only the full fields of a product's grid can be replaced by its grid.
+    if np.ndim(cLon) == 2:
+        product = getProduct(getGridProductType(*np.shape(cLon)))
+        cLon, cLat = getGridLonLat(product['nLat'], product['nLon'])
+    # Trim the lon and lat down (the same window as trimData)
+    rows, cols = getTrimSlices(cLon,cLat,minLon,maxLon,minLat,maxLat)
+    trimmedLon = cLon[cols]
+    trimmedLat = cLat[rows]
     # Create filled 2-d lon and lat fields
     lon2d=np.tile(trimmedLon,(len(trimmedLat),1))
     lat2d=np.transpose(np.tile(trimmedLat,(len(trimmedLon),1)))
@@ -239,9 +586,198 @@ def bitVal(intArr,qBit):
     '''
     Given array of whole, positive, decimal integers, return the boolean corresponding to whether or not the qBit-th bit associated with the binary equivalent is raised.
     '''
-    # Divide by 2 the number of times as bits requested
-    for nn in range(qBit):
-        intArr = intArr // 2
-    # Return a boolean that indicates whether the resulting values have a remainder when divided by two. This indicates that the flag is raised
-    raised = (intArr % 2).astype(bool)
+    # Integers to shift (flags read with NaN fill come as floats; NaN has no bit raised)
+    intArr = np.asarray(intArr)
+    if intArr.dtype.kind == 'f':
+        intArr = np.where(np.isnan(intArr), 0, intArr)
+    intArr = intArr.astype(np.int64, copy=False)
+    # Shift the requested bit to the first bit and see if it is raised. (To decode several flags at once, see decodeFlags in smapFlags.py.)
+    raised = (np.right_shift(intArr, qBit) & 1).astype(bool)
     return raised
+
+# Function to get the data type of the domain pixels: their lon/lat and IDs
+def getDomainDataType():
+    return np.dtype([('longitude',np.float32), ('latitude',np.float32), ('pixelId',np.dtype('U9'))])
+
+# Function to create the domain pixels of a regular lon/lat grid (every combination of lonVals and latVals, lon first, as 'nId<lon index><lat index>'). If landMask (a [len(lonVals),len(latVals)] boolean array) is given, only the pixels where it is True are kept.
+def makeDomain(lonVals, latVals, landMask=None):
+    # Indices of every lon/lat pair (the same order as a loop over lon, then lat)
+    oo, aa = np.meshgrid(np.arange(len(lonVals)), np.arange(len(latVals)), indexing='ij')
+    if landMask is not None:
+        oo = oo[landMask]
+        aa = aa[landMask]
+    oo = oo.ravel()
+    aa = aa.ravel()
+    domainPixelsArr = np.empty([len(oo)], dtype=getDomainDataType())
+    domainPixelsArr['longitude'] = np.asarray(lonVals)[oo]
+    domainPixelsArr['latitude'] = np.asarray(latVals)[aa]
+    domainPixelsArr['pixelId'] = np.char.add(np.char.add('nId', np.char.zfill(oo.astype(str), 3)), np.char.zfill(aa.astype(str), 3))
+    return domainPixelsArr
+
+# Function to get the land mask of a grid (see makeDomain) from a mask on another grid: a .npz file with the 1-d 'longitude' and 'latitude' of the mask grid and its [nLon,nLat] boolean 'mask'. Each pixel takes the value of the closest cell of the mask grid.
+def getLandMask(maskFile, lonVals, latVals):
+    with np.load(maskFile) as maskData:
+        lonIdcs = nearestIdcs(maskData['longitude'], lonVals)
+        latIdcs = nearestIdcs(maskData['latitude'], latVals)
+        return maskData['mask'][np.ix_(lonIdcs, latIdcs)].astype(bool)
+
+# Function to write the domain pixels to a domain file. The format follows the extension: '.npy' (numpy structured array), '.h5' (HDF5, one dataset per column) or else the text format of createDomain.py (one '<lon> <lat> <pixelId>' line per pixel).
+def writeDomain(domainFile, domainPixelsArr):
+    suffix = Path(domainFile).suffix
+    if suffix == '.npy':
+        np.save(domainFile, domainPixelsArr.astype(getDomainDataType()))
+    elif suffix == '.h5':
+        with h5.File(domainFile, 'w') as ff:
+            ff.create_dataset('longitude', data=domainPixelsArr['longitude'].astype(np.float32))
+            ff.create_dataset('latitude', data=domainPixelsArr['latitude'].astype(np.float32))
+            ff.create_dataset('pixelId', data=np.char.encode(domainPixelsArr['pixelId'], 'ascii'))
+    else:
+        # One printf-style format of every line at once (see formatAsString)
+        values = tuple(chain.from_iterable(zip(domainPixelsArr['longitude'].tolist(), domainPixelsArr['latitude'].tolist(), domainPixelsArr['pixelId'].tolist())))
+        with open(domainFile, 'w') as fid:
+            fid.write('#     Lon       Lat    PixelId\n')
+            fid.write(('%9.4f %9.4f    %s\n'*len(domainPixelsArr)) % values)
+
+# Function to read the domain file written by createDomain.py (see writeDomain for the formats) into a structured array of the pixel lon/lat and IDs. If a binary domain file does not exist but a text file of the same name does (as createDomain.py wrote before the binary formats), the text file is read.
+def readDomain(domainFile):
+    if not Path(domainFile).is_file() and Path(domainFile).with_suffix('.txt').is_file():
+        domainFile = Path(domainFile).with_suffix('.txt')
+    suffix = Path(domainFile).suffix
+    if suffix == '.npy':
+        return np.load(domainFile).astype(getDomainDataType())
+    if suffix == '.h5':
+        with h5.File(domainFile, 'r') as ff:
+            domainPixelsArr = np.empty([ff['pixelId'].shape[0]], dtype=getDomainDataType())
+            domainPixelsArr['longitude'] = ff['longitude'][()]
+            domainPixelsArr['latitude'] = ff['latitude'][()]
+            domainPixelsArr['pixelId'] = ff['pixelId'][()].astype(str)
+        return domainPixelsArr
+    # Text: parse every line at once (the header line starts with '#')
+    return np.loadtxt(domainFile, dtype=getDomainDataType(), comments='#', ndmin=1)
+
+# Function to return the indices (in domain order) of the domain pixels in one tile. The pixels are sorted by lon (then lat) and split into nTiles bands of (nearly) equal numbers of pixels, so each tile covers a compact window of the SMAP grid.
+def getTilePixels(domainPixelsArr, nTiles, tileIdx):
+    if not 0 <= tileIdx < nTiles:
+        raise ValueError("Tile index must be between 0 and " + str(nTiles-1))
+    order = np.lexsort((domainPixelsArr['latitude'], domainPixelsArr['longitude']))
+    return np.sort(np.array_split(order, nTiles)[tileIdx])
+
+# Function to return the tile to process (of nTiles): the first command line argument, or else the index of the job in a cluster array job (SLURM_ARRAY_TASK_ID or PBS_ARRAYID), or else 0. When the domain is not split (nTiles is 1), the tile is always 0.
+def getTileIdx(nTiles):
+    if nTiles == 1:
+        return 0
+    tileIdx = 0
+    if len(sys.argv) > 1:
+        tileIdx = int(sys.argv[1])
+    else:
+        for name in ['SLURM_ARRAY_TASK_ID', 'PBS_ARRAYID']:
+            if name in os.environ:
+                tileIdx = int(os.environ[name])
+                break
+    if not 0 <= tileIdx < nTiles:
+        raise ValueError("Tile index " + str(tileIdx) + " is not between 0 and " + str(nTiles-1))
+    return tileIdx
+
+# Function to return the tag added to the names of the output files of a tile ('' when the domain is not split)
+def getTileTag(nTiles, tileIdx):
+    if nTiles == 1:
+        return ''
+    return '_tile{0:03d}'.format(tileIdx)
+
+# Function to split the days from dateStart up to (but not including) dateEnd into batches of batchDays days. If availableDates is given, only those days are read (the others have no SMAP file).
+def getBatchDates(dateStart, dateEnd, batchDays, availableDates=None):
+    totDays = (dateEnd-dateStart).days
+    dates = [dateStart + dt.timedelta(days=dd) for dd in range(totDays)]
+    if availableDates is not None:
+        availableDates = set(availableDates)
+        dates = [date for date in dates if date in availableDates]
+    return [dates[bb:bb+batchDays] for bb in range(0, len(dates), batchDays)]
+
+# Function to read one day of SMAP data (am and pm) into columns, trimmed to the requested window. If pixels (latIdcs, lonIdcs in the window) are given, only the data of those pixels are kept ([nPixels,2] columns, see getSmapSmPixels). This is the unit of work of readBatches.
+def readSmapDay(date, smapDir, type, rows, cols, fields=None, qualityFilter=None, pixels=None):
+    # The SMAP hdf file name from this day
+    smapFn = getFn(date=date, smapDir=smapDir, type=type)
+    # The SMAP data of the pixels, streamed from that hdf file
+    if pixels is not None:
+        return getSmapSmPixels(fn=smapFn, latIdcs=pixels[0], lonIdcs=pixels[1], am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter, type=type)
+    # The SMAP data from that hdf file, trimmed to the window
+    return getSmapSmColumns(fn=smapFn, am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter, type=type)
+
+# Function to assemble the days of one batch into single [nLat,nLon,2*nDays] columns, or [nPixels,2*nDays] columns for days read by pixel (memory-mapped in spillDir if given)
+def assembleBatch(dates, dayData, spillDir=None):
+    batchData = None
+    for dd, (thisDate, trimmedData) in enumerate(zip(dates, dayData)):
+        print('Reading date ' + thisDate.isoformat() + '...')
+        # Initialize empty columns the same size as the window (plus an extra dimension for time) to hold this batch's data
+        if batchData is None:
+            shape = next(iter(trimmedData.values())).shape[:-1] + (len(dates)*2,)
+            batchData = allocateColumns(shape, [(name, column.dtype) for name, column in trimmedData.items()], spillDir)
+        # Write the data to this batch's data
+        for name, column in trimmedData.items():
+            batchData[name][...,(dd*2):(dd*2)+2] = column
+    return batchData
+
+# Function to assemble a batch from an iterable of days (see assembleBatch), adding to metrics (see smapMetrics.py) the time spent waiting for the days and the bytes read ('read') and the time spent copying them into the batch ('assemble')
+def assembleBatchTimed(dates, dayData, spillDir=None, metrics=None):
+    if metrics is None:
+        return assembleBatch(dates, dayData, spillDir)
+    readSeconds = [0.0]
+    def timedDays():
+        dayIter = iter(dayData)
+        while True:
+            tic = time.perf_counter()
+            trimmedData = next(dayIter, None)
+            if trimmedData is None:
+                return
+            seconds = time.perf_counter() - tic
+            readSeconds[0] += seconds
+            addMetrics(metrics, 'read', seconds, sizeOf(trimmedData))
+            yield trimmedData
+    tic = time.perf_counter()
+    batchData = assembleBatch(dates, timedDays(), spillDir)
+    addMetrics(metrics, 'assemble', time.perf_counter() - tic - readSeconds[0], sizeOf(batchData))
+    return batchData
+
+# Generator that yields the data of each of the dates (in order), read by the pool with at most nAhead days submitted at once. A day is released as soon as it is yielded, so at most nAhead days are held in memory.
+def readDaysAhead(pool, nAhead, dates, smapDir, type, rows, cols, fields=None, qualityFilter=None, pixels=None):
+    pending = deque()
+    nextDay = 0
+    while pending or nextDay < len(dates):
+        while nextDay < len(dates) and len(pending) < nAhead:
+            pending.append(pool.submit(readSmapDay, dates[nextDay], smapDir, type, rows, cols, fields, qualityFilter, pixels))
+            nextDay += 1
+        yield pending.popleft().result()
+
+# Generator that yields the data of each batch of dates (in order), as assembled by assembleBatch
+def readBatches(batchDates, smapDir, type, rows, cols, fields=None, nWorkers=0, prefetch=1, spillDir=None, qualityFilter=None, metrics=None, pixels=None):
+    '''
+    With nWorkers=0 the days are read one after the other in this process. Otherwise the days are read by a pool of nWorkers processes, and the days of up to prefetch batches beyond the one being yielded are read while the caller processes it (e.g. writes it to disk). The batches are always yielded in order, so the result is the same as a sequential read. Peak memory is roughly (prefetch+2) batches: the yielded one, the prefetched ones and the one being assembled. If pixels (latIdcs, lonIdcs) are given, the days are read by pixel (see readSmapDay) and the batches are already gathered.
+    If spillDir is given, the batches are assembled in memory-mapped files there (see allocateColumns). The days read by the workers are held in memory until they are copied into the batch, so then no batch is prefetched (prefetch is ignored) and at most nWorkers days are read ahead of the day being copied.
+    If metrics is given (see smapMetrics.py), the 'read' and 'assemble' stages are added to it. With workers, the 'read' time is the time this process waited for the days (reads that overlap the caller's work are free).
+    '''
+    # Sequential read
+    if nWorkers < 1:
+        for dates in batchDates:
+            yield assembleBatchTimed(dates, (readSmapDay(thisDate, smapDir, type, rows, cols, fields, qualityFilter, pixels) for thisDate in dates), spillDir, metrics)
+        return
+    # The scripts that use this are not guarded by __main__, so the workers must be forked rather than spawned
+    with ProcessPoolExecutor(max_workers=nWorkers, mp_context=mp.get_context('fork')) as pool:
+        # Spilled batches: one batch at a time, read a few days ahead
+        if spillDir is not None:
+            for dates in batchDates:
+                yield assembleBatchTimed(dates, readDaysAhead(pool, nWorkers, dates, smapDir, type, rows, cols, fields, qualityFilter, pixels), spillDir, metrics)
+            return
+        # Queue of the batches that have been submitted to the pool
+        pending = deque()
+        nextBatch = 0
+        while pending or nextBatch < len(batchDates):
+            # Keep the next batch and up to prefetch more batches in the pool
+            while nextBatch < len(batchDates) and len(pending) < prefetch+1:
+                dates = batchDates[nextBatch]
+                pending.append((dates, [pool.submit(readSmapDay, thisDate, smapDir, type, rows, cols, fields, qualityFilter, pixels) for thisDate in dates]))
+                nextBatch += 1
+            # Wait for the oldest batch. The prefetched batches keep being read while the caller processes it.
+            dates, futures = pending.popleft()
+            batchData = assembleBatchTimed(dates, (ff.result() for ff in futures), spillDir, metrics)
+            del futures
+            yield batchData
@@ -0,0 +1,75 @@
+'''
+Fixtures of the tests: a small synthetic SMAP archive (see smapSynthetic.py), a small domain, and runScript, which runs one of the scripts with some of its controls replaced.
+'''
+import datetime as dt
+import re
+import runpy
+import sys
+import numpy as np
+import pytest
+from pathlib import Path
+
+repoDir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(repoDir))
+
+from smapSynthetic import writeSyntheticArchive
+from smapUtils import makeDomain, writeDomain
+
+# Days of the synthetic archive
+archiveStart = dt.date(2015,3,31)
+archiveEnd = dt.date(2015,4,6)
+
+# Function to write a value as python source for the controls of a script (the scripts import datetime as dt)
+def toSource(value):
+    if isinstance(value, dt.date):
+        return 'dt.date({0},{1},{2})'.format(value.year, value.month, value.day)
+    if isinstance(value, Path):
+        return repr(str(value))
+    return repr(value)
+
+# Function to run a script of the repository with some of its controls (name -> value) replaced. Only the assignments of the Controls section of the script (up to the next '# ----' line) are replaced. The script is copied to workDir and run in this process (with the given command line arguments), and its globals are returned.
+def runScript(scriptName, workDir, controls, argv=()):
+    source = (repoDir / scriptName).read_text()
+    controlsStart = source.index('# Controls\n')
+    controlsEnd = source.find('\n# ----', controlsStart)
+    if controlsEnd < 0:
+        controlsEnd = len(source)
+    head, section, tail = source[:controlsStart], source[controlsStart:controlsEnd], source[controlsEnd:]
+    for name, value in controls.items():
+        section, nSub = re.subn('^' + name + r' = .*$', lambda match: name + ' = ' + toSource(value), section, flags=re.M)
+        if nSub == 0:
+            raise KeyError("No control " + name + " in " + scriptName)
+    source = head + section + tail
+    scriptFn = Path(workDir) / scriptName
+    scriptFn.write_text(source)
+    argvBefore = sys.argv
+    sys.argv = [str(scriptFn)] + [str(arg) for arg in argv]
+    try:
+        return runpy.run_path(str(scriptFn), run_name='__main__')
+    finally:
+        sys.argv = argvBefore
+
+@pytest.fixture(scope='session')
+def smapDir(tmp_path_factory):
+    smapDir = tmp_path_factory.mktemp('smapData')
+    writeSyntheticArchive(str(smapDir), archiveStart, archiveEnd)
+    return smapDir
+
+@pytest.fixture(scope='session')
+def domainFile(tmp_path_factory):
+    domainFile = tmp_path_factory.mktemp('domain') / 'domain.npy'
+    writeDomain(str(domainFile), makeDomain(np.arange(-100.9375, -98.0, 0.5), np.arange(38.0625, 39.0, 0.25)))
+    return domainFile
+
+@pytest.fixture
+def tsControls(tmp_path, smapDir, domainFile, monkeypatch):
+    # Tile indices must not come from the environment
+    monkeypatch.delenv('SLURM_ARRAY_TASK_ID', raising=False)
+    monkeypatch.delenv('PBS_ARRAYID', raising=False)
+    # Controls of createTimeseries.py for a quick run over the synthetic archive (one day per batch)
+    def tsControls(outDir, **controls):
+        Path(outDir).mkdir(parents=True, exist_ok=True)
+        defaults = {'dateStart': archiveStart, 'dateEnd': archiveEnd, 'batchDays': 1, 'nWorkers': 0, 'smapDir': str(smapDir), 'domainFile': str(domainFile), 'smapOutDir': str(outDir), 'storeFn': str(Path(outDir) / 'smapTs.h5'), 'cacheDir': str(tmp_path / 'cache'), 'spillDir': str(tmp_path / 'scratch'), 'profileFn': str(tmp_path / 'createTimeseries.prof')}
+        defaults.update(controls)
+        return defaults
+    return tsControls
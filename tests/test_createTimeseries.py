@@ -0,0 +1,134 @@
+import datetime as dt
+import shutil
+import h5py as h5
+import numpy as np
+import pytest
+import smapManifest
+from pathlib import Path
+from conftest import runScript, archiveStart, archiveEnd
+from smapFlags import flaggedMask
+from smapStore import exportTsStoreToText
+from smapUtils import getFn, getColumnFillValues
+
+# Function to read every output file of a run (text files and stores), except the manifests
+def readOutput(outDir):
+    output = {}
+    for fn in sorted(Path(outDir).iterdir()):
+        if fn.suffix == '.txt':
+            output[fn.name] = fn.read_bytes()
+        elif fn.suffix == '.h5' and not fn.name.startswith('manifest'):
+            with h5.File(fn, 'r') as ff:
+                output[fn.name + ':day'] = ff['day'][()]
+                for name in ff['timeseries']:
+                    output[fn.name + ':' + name] = ff['timeseries'][name][()]
+    return output
+
+# Function to raise in place of commitBatch (the batch has been written but not committed)
+def crashBeforeCommit(*args, **kwargs):
+    raise RuntimeError("Crash before the commit")
+
+@pytest.mark.parametrize('outputFormat', ['text', 'hdf5'])
+def test_rerun_after_crash_in_first_batch(tmp_path, tsControls, monkeypatch, outputFormat):
+    # Run without interruption
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'reference', outputFormat=outputFormat))
+    reference = readOutput(tmp_path / 'reference')
+    assert reference
+    # Crash inside the first batch (after its writes), then run again
+    outDir = tmp_path / 'resumed'
+    with monkeypatch.context() as patch:
+        patch.setattr(smapManifest, 'commitBatch', crashBeforeCommit)
+        with pytest.raises(RuntimeError):
+            runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat=outputFormat))
+    assert readOutput(outDir)
+    runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat=outputFormat))
+    resumed = readOutput(outDir)
+    assert list(resumed) == list(reference)
+    for name in reference:
+        np.testing.assert_array_equal(resumed[name], reference[name], err_msg=name)
+
+def test_refuses_output_without_manifest(tmp_path, tsControls, domainFile):
+    # Time series that no manifest accounts for are not rolled back (deleted)
+    outDir = tmp_path / 'legacy'
+    outDir.mkdir()
+    pixelId = np.load(domainFile)['pixelId'][0]
+    (outDir / (pixelId + '.txt')).write_text('longitude -100.9375\n')
+    with pytest.raises(ValueError):
+        runScript('createTimeseries.py', tmp_path, tsControls(outDir))
+    assert (outDir / (pixelId + '.txt')).read_text() == 'longitude -100.9375\n'
+
+def test_untiled_run_ignores_tile_argument(tmp_path, tsControls, monkeypatch):
+    # An untiled run writes the output of the whole domain, whatever the argument or array job
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '2')
+    outDir = tmp_path / 'untiled'
+    runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5'), argv=['3'])
+    assert (outDir / 'manifest_hdf5.json').is_file()
+    assert (outDir / 'smapTs.h5').is_file()
+
+# Function to copy the SMAP files of some dates of an archive
+def copyArchiveDates(smapDir, toDir, dates):
+    for date in dates:
+        fn = Path(getFn(date=date, smapDir=str(smapDir), type='SMP'))
+        toFn = Path(getFn(date=date, smapDir=str(toDir), type='SMP'))
+        toFn.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(fn, toFn)
+
+@pytest.mark.parametrize('batchDays', [1, 2])
+def test_update_mode_skips_missing_days(tmp_path, tsControls, smapDir, batchDays):
+    missingDate = dt.date(2015,4,3)
+    dates = [archiveStart + dt.timedelta(days=dd) for dd in range((archiveEnd-archiveStart).days)]
+    # The whole archive, from which the days of the outage are taken out afterwards
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'reference', outputFormat='hdf5'))
+    reference = readOutput(tmp_path / 'reference')
+    kept = np.repeat(np.array(dates) != missingDate, 2)
+    # An archive with an outage: the nightly update runs before and after the days that follow it arrive
+    gapDir = tmp_path / 'gapData'
+    outDir = tmp_path / 'updated'
+    copyArchiveDates(smapDir, gapDir, [date for date in dates if date < missingDate])
+    controls = tsControls(outDir, outputFormat='hdf5', smapDir=str(gapDir), updateMode=True, batchDays=batchDays)
+    runScript('createTimeseries.py', tmp_path, controls)
+    copyArchiveDates(smapDir, gapDir, [date for date in dates if date > missingDate])
+    runScript('createTimeseries.py', tmp_path, controls)
+    manifest = smapManifest.readManifest(outDir, 'hdf5')
+    assert manifest['skippedDates'] == [missingDate.isoformat()]
+    assert (manifest['firstDate'], manifest['lastDate']) == (archiveStart.isoformat(), dates[-1].isoformat())
+    updated = readOutput(outDir)
+    assert list(updated) == list(reference)
+    for name in reference:
+        np.testing.assert_array_equal(updated[name], reference[name][...,kept], err_msg=name)
+
+qualityFilter = {'retrieval_qual_flag': ['not_recommended_quality'], 'surface_flag': ['static_water']}
+
+def test_quality_filter_matches_filtered_export(tmp_path, tsControls):
+    # Text files written with the filter, and the text files of an unfiltered store exported through the same filter
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'filtered', qualityFilter=qualityFilter))
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'store', outputFormat='hdf5'))
+    for name, exportFilter in [('exported', qualityFilter), ('unfiltered', None)]:
+        (tmp_path / name).mkdir()
+        exportTsStoreToText(str(tmp_path / 'store' / 'smapTs.h5'), str(tmp_path / name), qualityFilter=exportFilter)
+    filtered = readOutput(tmp_path / 'filtered')
+    exported = readOutput(tmp_path / 'exported')
+    assert list(filtered) == list(exported)
+    for name in exported:
+        assert filtered[name] == exported[name], name
+    # The filter left some retrievals out
+    unfiltered = readOutput(tmp_path / 'unfiltered')
+    assert sum(text.count(b'\n') for text in filtered.values()) < sum(text.count(b'\n') for text in unfiltered.values())
+
+def test_quality_filter_fills_rejected_retrievals(tmp_path, tsControls):
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'filtered', outputFormat='hdf5', qualityFilter=qualityFilter))
+    runScript('createTimeseries.py', tmp_path, tsControls(tmp_path / 'store', outputFormat='hdf5'))
+    filtered = readOutput(tmp_path / 'filtered')
+    store = readOutput(tmp_path / 'store')
+    rejected = flaggedMask({field: store['smapTs.h5:' + field] for field in qualityFilter}, qualityFilter)
+    assert rejected.any() and not rejected.all()
+    fillValues = getColumnFillValues()
+    for name in fillValues:
+        values = filtered['smapTs.h5:' + name]
+        # The pass of a time step is recorded whether there is a retrieval or not
+        if name == 'localTime':
+            np.testing.assert_array_equal(values, store['smapTs.h5:' + name])
+            continue
+        # Rejected retrievals are filled as if there was no retrieval; the others are kept
+        assert (values[rejected] == fillValues[name]).all(), name
+        np.testing.assert_array_equal(values[~rejected], store['smapTs.h5:' + name][~rejected], err_msg=name)
+    np.testing.assert_array_equal(filtered['smapTs.h5:day'], store['smapTs.h5:day'])
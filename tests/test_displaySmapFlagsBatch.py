@@ -0,0 +1,13 @@
+import datetime as dt
+import pytest
+from conftest import runScript
+
+pytest.importorskip('matplotlib')
+pytest.importorskip('mpl_toolkits.basemap')
+
+def test_renders_one_day_and_flag(tmp_path, smapDir):
+    figDir = tmp_path / 'figures'
+    controls = {'figDir': str(figDir) + '/', 'smapDir': str(smapDir), 'minLon': -102, 'maxLon': -97, 'minLat': 37, 'maxLat': 40, 'dateStart': dt.date(2015,4,1), 'dateEnd': dt.date(2015,4,2), 'passes': ['AM'], 'flags': [('surface_flag', 'static_water')], 'nWorkers': 0}
+    runScript('displaySmapFlagsBatch.py', tmp_path, controls)
+    assert [fn.name for fn in figDir.iterdir()] == ['static_water_20150401_AM.png']
+    assert (figDir / 'static_water_20150401_AM.png').stat().st_size > 0
@@ -0,0 +1,94 @@
+import datetime as dt
+import json
+import numpy as np
+import pytest
+import smapManifest
+from conftest import runScript
+from smapAggregate import getAggregateGroups, getGroupKeys, getAggregateProducts, readAggregates, createAggregates, openAggregates, closeAggregates, updateAggregates, rollbackAggregates
+from smapQuery import openTsQuery, closeTsQuery, queryPixels
+from smapUtils import getColumnFillValues
+
+aggregateFields = ['soil_moisture', 'tb_v_corrected']
+
+# Function to read the statistics kept with the manifest of an output directory
+def readManifestStats(outDir, outputFormat='hdf5', tag=''):
+    manifest = json.loads((outDir / ('manifest_' + outputFormat + tag + '.json')).read_text())
+    return readAggregates(outDir / manifest['aggregatesFile'])
+
+# Function to check statistics against the ones computed from the whole time series of the store
+def checkAgainstStore(aggregates, storeFn):
+    query = openTsQuery(storeFn)
+    tsData, days = queryPixels(query, np.arange(len(query['pixelIds'])))
+    closeTsQuery(query)
+    for field in aggregateFields:
+        values = np.where(tsData[field] != getColumnFillValues()[field], tsData[field], np.nan).astype(np.float64)
+        for group in getAggregateGroups():
+            stepKeys = getGroupKeys(days, group)
+            keys, products = getAggregateProducts(aggregates, field, group)
+            np.testing.assert_array_equal(keys, np.unique(stepKeys))
+            for kk, key in enumerate(keys):
+                keyValues = values[:, stepKeys == key]
+                count = np.isfinite(keyValues).sum(axis=1)
+                np.testing.assert_array_equal(products['count'][:,kk], count)
+                has = count > 0
+                np.testing.assert_allclose(products['mean'][has,kk], np.nanmean(keyValues[has], axis=1), rtol=1e-10)
+                np.testing.assert_allclose(products['min'][has,kk], np.nanmin(keyValues[has], axis=1))
+                np.testing.assert_allclose(products['max'][has,kk], np.nanmax(keyValues[has], axis=1))
+                many = count > 1
+                np.testing.assert_allclose(products['variance'][many,kk], np.nanvar(keyValues[many], axis=1, ddof=1), rtol=1e-8, atol=1e-12)
+
+def test_statistics_match_the_store(tmp_path, tsControls):
+    outDir = tmp_path / 'out'
+    runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5', aggregateFields=aggregateFields))
+    checkAgainstStore(readManifestStats(outDir), outDir / 'smapTs.h5')
+
+def test_statistics_of_uncommitted_batch_are_rolled_back(tmp_path, tsControls, monkeypatch):
+    outDir = tmp_path / 'out'
+    # Crash after the statistics of the third batch were updated, before it is committed
+    commitBatch = smapManifest.commitBatch
+    nCommits = [0]
+    def crashAtThirdCommit(*args, **kwargs):
+        nCommits[0] += 1
+        if nCommits[0] == 3:
+            raise RuntimeError("Crash before the commit")
+        commitBatch(*args, **kwargs)
+    with monkeypatch.context() as patch:
+        patch.setattr(smapManifest, 'commitBatch', crashAtThirdCommit)
+        with pytest.raises(RuntimeError):
+            runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5', aggregateFields=aggregateFields))
+    runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5', aggregateFields=aggregateFields))
+    checkAgainstStore(readManifestStats(outDir), outDir / 'smapTs.h5')
+
+def test_statistics_of_merged_tiles(tmp_path, tsControls):
+    outDir = tmp_path / 'out'
+    for tileIdx in range(2):
+        runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5', aggregateFields=aggregateFields, nTiles=2, dateEnd=dt.date(2015,4,4)), argv=[tileIdx])
+    runScript('mergeTiles.py', tmp_path, {'domainFile': tsControls(outDir)['domainFile'], 'smapOutDir': str(outDir), 'outputFormat': 'hdf5', 'storeFn': str(outDir / 'smapTs.h5'), 'nTiles': 2})
+    checkAgainstStore(readManifestStats(outDir), outDir / 'smapTs.h5')
+    # The merged output (and its statistics) is extended by an untiled run
+    runScript('createTimeseries.py', tmp_path, tsControls(outDir, outputFormat='hdf5', dateEnd=dt.date(2015,4,6)))
+    checkAgainstStore(readManifestStats(outDir), outDir / 'smapTs.h5')
+
+def test_update_rewrites_only_the_keys_of_the_batch(tmp_path):
+    fn = tmp_path / 'stats.h5'
+    createAggregates(fn, 3, ['soil_moisture'], ['dayOfYear'])
+    aggregates = openAggregates(fn)
+    dates = [dt.date(2015,4,1), dt.date(2015,4,2)]
+    batchTs = {'soil_moisture': np.array([[0.1, 0.2, 0.3, -9999.0], [0.4, -9999.0, -9999.0, -9999.0], [-9999.0]*4], dtype=np.float32)}
+    updateAggregates(aggregates, batchTs, dates)
+    ds = aggregates['file']['soil_moisture/dayOfYear/mean']
+    assert ds.shape == (3, 2)
+    # A batch of another day adds its column and leaves the others as they are
+    before = ds[()]
+    updateAggregates(aggregates, {'soil_moisture': batchTs['soil_moisture'][:, :2]}, [dt.date(2015,4,3)])
+    assert ds.shape == (3, 3)
+    np.testing.assert_array_equal(ds[:, :2], before)
+    # Rolling back the uncommitted batch restores the statistics of the first one
+    rollbackAggregates(aggregates, 1)
+    assert ds.shape == (3, 2)
+    np.testing.assert_array_equal(ds[()], before)
+    assert aggregates['file'].attrs['nBatches'] == 1
+    closeAggregates(aggregates)
+    stats = readAggregates(fn)['soil_moisture']['dayOfYear']
+    np.testing.assert_array_equal(stats['count'], [[2, 1], [1, 0], [0, 0]])
+    np.testing.assert_allclose(stats['mean'][0], [0.15, 0.3], rtol=1e-6)
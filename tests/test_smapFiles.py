@@ -0,0 +1,48 @@
+import multiprocessing as mp
+import numpy as np
+import pytest
+from smapFiles import atomicWrite, readCache, writeCache
+from smapGrid import getGridLonLat
+from smapUtils import makeDomain, selectSmapPixels
+
+# Function to start nProcs processes at once that call func(*args) and return whether each of them succeeded
+def runAtOnce(func, args, nProcs=8):
+    ctx = mp.get_context('fork')
+    barrier = ctx.Barrier(nProcs)
+    def run():
+        barrier.wait()
+        func(*args)
+    procs = [ctx.Process(target=run) for pp in range(nProcs)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return [proc.exitcode == 0 for proc in procs]
+
+@pytest.mark.parametrize('repeat', range(3))
+def test_concurrent_runs_share_an_empty_cache(tmp_path, repeat):
+    # The tiles of an array job start at the same time with the same (empty) cache directory
+    cacheDir = tmp_path / 'cache'
+    assert all(runAtOnce(getGridLonLat, (1624, 3856, cacheDir)))
+    lonData, latData = getGridLonLat(1624, 3856)
+    cachedLon, cachedLat = getGridLonLat(1624, 3856, cacheDir)
+    np.testing.assert_array_equal(cachedLon, lonData)
+    np.testing.assert_array_equal(cachedLat, latData)
+    domainPixelsArr = makeDomain(np.arange(-100.9375, -98.0, 0.125), np.arange(38.0625, 39.0, 0.125))
+    assert all(runAtOnce(selectSmapPixels, (lonData, latData, domainPixelsArr, cacheDir)))
+    for cached, computed in zip(selectSmapPixels(lonData, latData, domainPixelsArr, cacheDir), selectSmapPixels(lonData, latData, domainPixelsArr)):
+        np.testing.assert_array_equal(cached, computed)
+    # No temporary file is left behind
+    assert sorted(fn.suffix for fn in cacheDir.iterdir()) == ['.npz', '.npz']
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    cacheFn = tmp_path / 'cache' / 'arrays.npz'
+    assert readCache(cacheFn) is None
+    writeCache(cacheFn, values=np.arange(3))
+    def failingWrite(fid):
+        fid.write(b'partial')
+        raise RuntimeError("Interrupted write")
+    with pytest.raises(RuntimeError):
+        atomicWrite(cacheFn, failingWrite)
+    np.testing.assert_array_equal(readCache(cacheFn)['values'], np.arange(3))
+    assert [fn.name for fn in cacheFn.parent.iterdir()] == ['arrays.npz']
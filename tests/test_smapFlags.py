@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from smapFlags import getFlagTable, decodeFlags
+from smapUtils import bitVal
+
+# Flag values with every bit pattern of the low bits, and some of the high ones
+flagValues = np.arange(0, 65536, 7, dtype=np.uint16).reshape(-1, 3)
+
+def test_decoded_flags_are_their_bits():
+    data = {field: flagValues for field in getFlagTable()}
+    flags = decodeFlags(data)
+    for field, names in getFlagTable().items():
+        assert list(flags[field]) == list(names)
+        for name, bit in names.items():
+            assert flags[field][name].dtype == bool and flags[field][name].shape == flagValues.shape
+            np.testing.assert_array_equal(flags[field][name], bitVal(flagValues, bit), err_msg=field + ' ' + name)
+
+def test_only_requested_flags_are_decoded():
+    flags = decodeFlags({'surface_flag': flagValues, 'retrieval_qual_flag': flagValues}, {'surface_flag': ['static_water']})
+    assert list(flags) == ['surface_flag']
+    assert list(flags['surface_flag']) == ['static_water']
+    # One byte per value
+    assert flags['surface_flag']['static_water'].nbytes == flagValues.size
+    with pytest.raises(NameError):
+        decodeFlags({'surface_flag': flagValues}, {'surface_flag': ['no_such_flag']})
+
+def test_decoded_flags_of_floats():
+    # Flags read with NaN fill: the same flags as the integers, and none raised for NaN
+    values = np.array([5.0, 4.0, np.nan])
+    flags = decodeFlags({'retrieval_qual_flag': values}, {'retrieval_qual_flag': ['not_recommended_quality', 'retrieval_failed']})
+    np.testing.assert_array_equal(flags['retrieval_qual_flag']['not_recommended_quality'], [True, False, False])
+    np.testing.assert_array_equal(flags['retrieval_qual_flag']['retrieval_failed'], [True, True, False])
@@ -0,0 +1,78 @@
+import datetime as dt
+import shutil
+import h5py as h5
+import numpy as np
+import pytest
+from pathlib import Path
+from conftest import runScript
+from smapProducts import getProduct, getDatasetName
+from smapQuery import openTsQuery, closeTsQuery, queryPixels, readTextTs
+from smapUtils import getFn, getColumnFillValues
+
+# Day of the SMAP file whose PM retrievals are moved to the next UTC day
+crossDate = dt.date(2015,4,2)
+
+@pytest.fixture(scope='module')
+def crossingOutput(tmp_path_factory, smapDir, domainFile):
+    # A copy of the archive where the PM retrievals of crossDate are after midnight UTC (on the next day), as the evening overpasses of the Americas are
+    tmpDir = tmp_path_factory.mktemp('crossing')
+    crossDir = tmpDir / 'smapData'
+    shutil.copytree(smapDir, crossDir)
+    product = getProduct('SMP')
+    pmGrp, pmSuffix = product['passes'][1]
+    with h5.File(getFn(date=crossDate, smapDir=str(crossDir), type='SMP'), 'a') as ff:
+        ds = ff[pmGrp][getDatasetName(product, 'tb_time_utc', pmSuffix)]
+        times = ds[()]
+        valid = times != b'N/A'
+        shifted = np.datetime64(crossDate + dt.timedelta(days=1)) + np.timedelta64(1800000, 'ms')
+        times[valid] = np.char.add(np.datetime_as_string(np.full(valid.sum(), shifted), unit='ms'), 'Z').astype('S24')
+        ds[...] = times
+    # The time series of the archive, as text files and as a store
+    outDirs = {}
+    for outputFormat in ['text', 'hdf5']:
+        outDirs[outputFormat] = tmpDir / outputFormat
+        outDirs[outputFormat].mkdir()
+        controls = {'dateStart': dt.date(2015,3,31), 'dateEnd': dt.date(2015,4,6), 'batchDays': 2, 'nWorkers': 0, 'smapDir': str(crossDir), 'domainFile': str(domainFile), 'smapOutDir': str(outDirs[outputFormat]), 'storeFn': str(outDirs[outputFormat] / 'smapTs.h5'), 'cacheDir': None, 'outputFormat': outputFormat}
+        runScript('createTimeseries.py', tmpDir, controls)
+    return outDirs
+
+@pytest.mark.parametrize('dateStart, dateEnd', [(dt.date(2015,3,31), crossDate+dt.timedelta(days=1)), (crossDate+dt.timedelta(days=1), dt.date(2015,4,5)), (None, None)])
+def test_text_and_store_queries_agree(crossingOutput, dateStart, dateEnd):
+    query = openTsQuery(crossingOutput['hdf5'] / 'smapTs.h5')
+    tsData, days = queryPixels(query, np.arange(len(query['pixelIds'])), dateStart, dateEnd)
+    pixelIds = query['pixelIds']
+    closeTsQuery(query)
+    fillValues = getColumnFillValues()
+    nCompared = 0
+    for pp, pixelId in enumerate(pixelIds):
+        textFn = crossingOutput['text'] / (pixelId + '.txt')
+        if not textFn.is_file():
+            assert (tsData['longitude'][pp] == fillValues['longitude']).all()
+            continue
+        textTs = readTextTs(textFn, dateStart, dateEnd)
+        # The retrievals of the store, in time order (the same order as the rows of the text file)
+        has = tsData['longitude'][pp] != fillValues['longitude']
+        assert has.sum() == len(textTs['tb_time_utc']), pixelId
+        np.testing.assert_array_equal(tsData['tb_time_utc'][pp][has], textTs['tb_time_utc'])
+        for name in ['localTime', 'surface_flag', 'retrieval_qual_flag', 'tb_qual_flag_v']:
+            np.testing.assert_array_equal(tsData[name][pp][has], textTs[name])
+        for name in ['soil_moisture', 'soil_moisture_error', 'tb_v_corrected', 'vegetation_water_content']:
+            np.testing.assert_allclose(tsData[name][pp][has], textTs[name], atol=0.006)
+        nCompared += has.sum()
+    assert nCompared > 0
+
+def test_crossing_retrievals_are_selected_by_utc_day(crossingOutput):
+    query = openTsQuery(crossingOutput['hdf5'] / 'smapTs.h5')
+    nextDay = crossDate + dt.timedelta(days=1)
+    # Up to crossDate: its PM retrievals (on the next UTC day) are left out
+    tsData, days = queryPixels(query, np.arange(len(query['pixelIds'])), crossDate, nextDay, ['tb_time_utc', 'localTime'])
+    assert (days == np.datetime64(crossDate)).all()
+    pm = tsData['localTime'] == 1
+    assert (tsData['tb_time_utc'][pm] == getColumnFillValues()['tb_time_utc']).all()
+    # From the next day: they are included, with the time step of their file
+    tsData, days = queryPixels(query, np.arange(len(query['pixelIds'])), nextDay, nextDay+dt.timedelta(days=1), ['tb_time_utc', 'localTime'])
+    closeTsQuery(query)
+    fromCrossDate = days == np.datetime64(crossDate)
+    assert fromCrossDate.sum() == 1
+    assert (tsData['localTime'][:,fromCrossDate] == 1).all()
+    assert (tsData['tb_time_utc'][:,fromCrossDate] != getColumnFillValues()['tb_time_utc']).any()
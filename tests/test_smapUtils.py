@@ -0,0 +1,163 @@
+import shutil
+import sys
+import h5py as h5
+import numpy as np
+import pytest
+from conftest import archiveStart
+from smapGrid import getGridLonLat
+from smapProducts import getProduct
+from smapUtils import getTileIdx, bitVal, getFn, getSmapSmColumns, getSmapSmPixels, gatherColumns, getColumnFillValues, getSmapLonLat, getTrimSlices, processLatLon, makeDomain, writeDomain, readDomain
+
+def test_tile_of_untiled_domain_is_0(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['createTimeseries.py', '3'])
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '5')
+    assert getTileIdx(1) == 0
+
+def test_tile_from_argument_or_array_job(monkeypatch):
+    monkeypatch.delenv('PBS_ARRAYID', raising=False)
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '2')
+    monkeypatch.setattr(sys, 'argv', ['createTimeseries.py'])
+    assert getTileIdx(4) == 2
+    monkeypatch.setattr(sys, 'argv', ['createTimeseries.py', '1'])
+    assert getTileIdx(4) == 1
+
+def test_tile_out_of_range(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['createTimeseries.py', '4'])
+    with pytest.raises(ValueError):
+        getTileIdx(4)
+    monkeypatch.setattr(sys, 'argv', ['createTimeseries.py', '-1'])
+    with pytest.raises(ValueError):
+        getTileIdx(4)
+
+def test_bitVal_of_integers():
+    np.testing.assert_array_equal(bitVal(np.array([5, 4, 65534], dtype=np.uint16), 2), [True, True, True])
+    np.testing.assert_array_equal(bitVal(np.array([5, 4, 65534], dtype=np.uint16), 0), [True, False, False])
+
+def test_bitVal_of_floats():
+    # Flags read with NaN fill are floats: the same bits as the integers, and no bit raised for NaN
+    np.testing.assert_array_equal(bitVal(np.array([5.0, 4.0]), 2), [True, True])
+    np.testing.assert_array_equal(bitVal(np.array([5.0, 4.0, np.nan]), 0), [True, False, False])
+
+# Function to read the lon/lat fields of a synthetic SMAP file, which are filled (-9999.0) where there is no retrieval
+def readFilledLonLat(smapDir):
+    smapLonLat = getSmapLonLat(getFn(date=archiveStart, smapDir=str(smapDir), type='SMP'))
+    # Whole columns and rows of the file have no value
+    assert (smapLonLat['longitude'] == -9999.0).all(axis=0).any()
+    assert (smapLonLat['latitude'] == -9999.0).all(axis=1).any()
+    return smapLonLat['longitude'], smapLonLat['latitude']
+
+def test_grid_of_filled_file(smapDir):
+    # The lon/lat of the retrievals of a file are those of the grid
+    lon2d, lat2d = readFilledLonLat(smapDir)
+    gridLon, gridLat = getGridLonLat()
+    has = lon2d != -9999.0
+    np.testing.assert_array_equal(lon2d[has], np.broadcast_to(gridLon, lon2d.shape)[has])
+    np.testing.assert_array_equal(lat2d[has], np.broadcast_to(gridLat[:,None], lat2d.shape)[has])
+    # The CONUS window of the grid
+    rows, cols = getTrimSlices(gridLon, gridLat, -125, -66, 24, 50)
+    assert gridLon[cols.start] >= -125 and gridLon[cols.start-1] < -125
+    assert gridLon[cols.stop-1] <= -66 and gridLon[cols.stop] > -66
+    assert gridLat[rows.start] <= 50 and gridLat[rows.start-1] > 50
+    assert gridLat[rows.stop-1] >= 24 and gridLat[rows.stop] < 24
+
+def test_processLatLon_of_filled_fields(smapDir):
+    # The 2-d fields of a file give the same mesh as the 1-d grid
+    lon2d, lat2d = readFilledLonLat(smapDir)
+    gridLon, gridLat = getGridLonLat()
+    eLons, eLats = processLatLon(None, lon2d, lat2d, -125, -66, 24, 50)
+    gridELons, gridELats = processLatLon(None, gridLon, gridLat, -125, -66, 24, 50)
+    np.testing.assert_array_equal(eLons, gridELons)
+    np.testing.assert_array_equal(eLats, gridELats)
+    assert np.isfinite(eLons).all() and np.isfinite(eLats).all()
+    assert eLons.min() >= -125.5 and eLons.max() <= -65.5
+
+def test_processLatLon_of_9km_fields():
+    # The full 2-d fields of the 9 km grid give the mesh of that grid
+    gridLon, gridLat = getGridLonLat(1624, 3856)
+    lon2d, lat2d = np.meshgrid(gridLon, gridLat)
+    eLons, eLats = processLatLon(None, lon2d, lat2d, -102, -97, 37, 40)
+    gridELons, gridELats = processLatLon(None, gridLon, gridLat, -102, -97, 37, 40)
+    np.testing.assert_array_equal(eLons, gridELons)
+    np.testing.assert_array_equal(eLats, gridELats)
+    assert eLons.shape == (len(gridLat[(gridLat >= 37) & (gridLat <= 40)])+1, len(gridLon[(gridLon >= -102) & (gridLon <= -97)])+1)
+
+def test_processLatLon_of_trimmed_fields(smapDir):
+    # 2-d fields that are not those of a whole grid cannot be replaced by a grid
+    lon2d, lat2d = readFilledLonLat(smapDir)
+    with pytest.raises(ValueError):
+        processLatLon(None, lon2d[100:200, 200:400], lat2d[100:200, 200:400], -125, -66, 24, 50)
+
+@pytest.mark.parametrize('suffix', ['.npy', '.h5', '.txt'])
+def test_domain_formats(tmp_path, suffix):
+    domainPixelsArr = makeDomain(np.arange(-100.9375, -98.0, 0.125), np.arange(38.0625, 39.0, 0.125))
+    writeDomain(str(tmp_path / ('domain' + suffix)), domainPixelsArr)
+    np.testing.assert_array_equal(readDomain(str(tmp_path / ('domain' + suffix))), domainPixelsArr)
+
+def test_domain_falls_back_to_text(tmp_path):
+    # Setups that only have the text domain keep working with the binary default
+    domainPixelsArr = makeDomain(np.arange(-100.9375, -98.0, 0.125), np.arange(38.0625, 39.0, 0.125))
+    writeDomain(str(tmp_path / 'nldasDomainSection.txt'), domainPixelsArr)
+    np.testing.assert_array_equal(readDomain(str(tmp_path / 'nldasDomainSection.npy')), domainPixelsArr)
+    with pytest.raises(FileNotFoundError):
+        readDomain(str(tmp_path / 'otherDomain.npy'))
+
+@pytest.mark.parametrize('fields, qualityFilter', [(None, None), (['soil_moisture'], None), (['soil_moisture', 'tb_time_utc'], {'retrieval_qual_flag': ['not_recommended_quality']}), (['surface_flag', 'soil_moisture'], {'surface_flag': ['static_water', 'dense_vegetation']})])
+def test_pixels_are_those_of_the_window(smapDir, fields, qualityFilter):
+    fn = getFn(date=archiveStart, smapDir=str(smapDir), type='SMP')
+    # A window across the boundary of two chunks of rows (the chunks of the synthetic files are 203 rows high), and pixels (some twice) in both
+    rows, cols = slice(150, 260), slice(300, 420)
+    rng = np.random.default_rng(0)
+    latIdcs = rng.integers(0, 110, 500)
+    lonIdcs = rng.integers(0, 120, 500)
+    pixelColumns = getSmapSmPixels(fn, latIdcs, lonIdcs, am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter)
+    windowColumns = gatherColumns(getSmapSmColumns(fn, am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter), latIdcs, lonIdcs)
+    assert list(pixelColumns) == list(windowColumns)
+    for name in windowColumns:
+        np.testing.assert_array_equal(pixelColumns[name], windowColumns[name], err_msg=name)
+    if qualityFilter:
+        # Some retrievals were rejected, and some were kept
+        name = fields[-1]
+        rejected = pixelColumns[name] == getColumnFillValues()[name]
+        assert rejected.any() and not rejected.all()
+
+def test_fully_rejected_pass_is_not_read(smapDir, tmp_path, monkeypatch):
+    # A copy of a file where every AM retrieval has not recommended quality: the readers must not read the AM data of the fields
+    fn = getFn(date=archiveStart, smapDir=str(smapDir), type='SMP')
+    rejectedFn = tmp_path / 'rejectedAm.h5'
+    shutil.copy(fn, rejectedFn)
+    product = getProduct('SMP')
+    amGrp = product['passes'][0][0]
+    with h5.File(rejectedFn, 'a') as ff:
+        ff[amGrp]['retrieval_qual_flag'][...] = 1
+    qualityFilter = {'retrieval_qual_flag': ['not_recommended_quality']}
+    fields = ['longitude', 'soil_moisture', 'tb_time_utc']
+    rows, cols = slice(150, 260), slice(300, 420)
+    rng = np.random.default_rng(1)
+    latIdcs = rng.integers(0, 110, 300)
+    lonIdcs = rng.integers(0, 120, 300)
+    # Record the datasets that are read
+    readNames = []
+    getItem = h5.Dataset.__getitem__
+    readDirect = h5.Dataset.read_direct
+    def recordGetItem(ds, *args, **kwargs):
+        readNames.append(ds.name)
+        return getItem(ds, *args, **kwargs)
+    def recordReadDirect(ds, *args, **kwargs):
+        readNames.append(ds.name)
+        return readDirect(ds, *args, **kwargs)
+    monkeypatch.setattr(h5.Dataset, '__getitem__', recordGetItem)
+    monkeypatch.setattr(h5.Dataset, 'read_direct', recordReadDirect)
+    # The window is read whole, the pixels block by block (every block of the AM pass is rejected)
+    windowColumns = getSmapSmColumns(rejectedFn, am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter)
+    pixelColumns = getSmapSmPixels(rejectedFn, latIdcs, lonIdcs, am=True, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter)
+    assert set(name for name in readNames if name.startswith('/' + amGrp + '/')) == {'/' + amGrp + '/retrieval_qual_flag'}
+    assert '/' + product['passes'][1][0] + '/soil_moisture_pm' in readNames
+    # The PM pass is read as from the original file
+    pmColumns = getSmapSmColumns(fn, am=False, pm=True, rows=rows, cols=cols, fields=fields, qualityFilter=qualityFilter)
+    fillValues = getColumnFillValues()
+    for name in fields:
+        assert (windowColumns[name][:,:,0] == fillValues[name]).all()
+        assert (pixelColumns[name][:,0] == fillValues[name]).all()
+        np.testing.assert_array_equal(windowColumns[name][:,:,1], pmColumns[name][:,:,1])
+        np.testing.assert_array_equal(pixelColumns[name][:,1], pmColumns[name][latIdcs,lonIdcs,1])
+    assert (pmColumns['longitude'][:,:,1] != fillValues['longitude']).any()